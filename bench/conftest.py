@@ -0,0 +1,22 @@
+import pytest
+
+from test_fsm_comp_time import load_tokenizer
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--save-fsm-results",
+        action="store_true",
+        default=False,
+        help="Write the compile benchmark results to bench/benchmark_results.json.",
+    )
+
+
+@pytest.fixture(scope="session")
+def tokenizer():
+    return load_tokenizer()
+
+
+@pytest.fixture
+def save_fsm_results(request):
+    return request.config.getoption("--save-fsm-results")
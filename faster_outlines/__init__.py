@@ -1,13 +1,36 @@
 from .patch import patch
-from .fsm import *
+from . import fsm as _fsm
+from .fsm.environment import NO_WARMUP as _NO_WARMUP
+
+if not _NO_WARMUP:
+    # Load the rust extension now rather than inside the first guide build.
+    # Everything else ( torch, interegular, ... ) is still imported lazily.
+    from .fsm import fsm_utils as _fsm_utils
+
+
+def __getattr__(name):
+    # Resolved lazily, see `faster_outlines.fsm`.
+    if name not in _fsm.__all__:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    value = getattr(_fsm, name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_fsm.__all__))
+
 
 __all__ = [
   "FsmTokenizer", 
   "create_fsm_index_tokenizer", 
+  "create_fsm_indices_tokenizer",
   "FSMState", 
   "patch",
   "Generate", 
-  "Write"
+  "Write",
+  "warmup"
 ]
 
 __doc__ = """
@@ -1,18 +1,36 @@
-from .tokenizer_fsm_patch import TransformerTokenizer as FsmTokenizer
+# Attributes are imported lazily ( PEP 562 ), so interegular and torch are only loaded
+# once something actually needs them. The rust extension is loaded eagerly by the
+# top-level `faster_outlines` import, unless `FASTER_OUTLINES_NO_WARMUP` is set.
+import importlib
 
-from .fsm_utils import (
-    create_fsm_index_end_to_end, 
-    Generate,
-    Write
-)
+_LAZY_ATTRIBUTES = {
+    "FsmTokenizer": (".tokenizer_fsm_patch", "TransformerTokenizer"),
+    "create_fsm_index_end_to_end": (".fsm_utils", "create_fsm_index_end_to_end"),
+    "create_fsm_indices_batch": (".fsm_utils", "create_fsm_indices_batch"),
+    "Generate": (".fsm_utils", "Generate"),
+    "Write": (".fsm_utils", "Write"),
+    "create_fsm_index_tokenizer": (".regex", "create_fsm_index_tokenizer"),
+    "create_fsm_indices_tokenizer": (".regex", "create_fsm_indices_tokenizer"),
+    "FSMState": (".regex", "FSMState"),
+    "warmup": (".regex", "warmup"),
+    "RegexGuide": (".guide", "RegexGuide"),
+}
 
-from .regex import (
-    create_fsm_index_tokenizer,
-    FSMState
-)
 
-from .guide import RegexGuide
+def __getattr__(name):
+    try:
+        module_name, attribute = _LAZY_ATTRIBUTES[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
 
+    value = getattr(importlib.import_module(module_name, __name__), attribute)
+    # Cache it on the module, so the next lookups do not go through `__getattr__`.
+    globals()[name] = value
+    return value
 
 
-__all__ = [ "FsmTokenizer", "create_fsm_index_tokenizer", "FSMState", "Generate", "Write", "RegexGuide"]
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
+
+
+__all__ = [ "FsmTokenizer", "create_fsm_index_tokenizer", "create_fsm_indices_tokenizer", "FSMState", "Generate", "Write", "RegexGuide", "warmup"]
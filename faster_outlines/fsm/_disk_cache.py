@@ -0,0 +1,64 @@
+# On-disk cache of computed FSM indexes, shared between processes.
+# Enabled by `FASTER_OUTLINES_DISK_CACHE_DIR`, see `environment.py`.
+import os
+import threading
+from hashlib import blake2b
+from importlib.metadata import PackageNotFoundError, version
+from typing import Optional
+
+from .environment import DISK_CACHE_DIR
+from .fsm_utils import LazyFSMIndex
+
+
+# Bumped whenever the content of cached indexes changes for the same key, e.g. how the
+# vocabulary is reduced or decoded. The package version is part of the key as well, so
+# entries written by another release are never reused.
+FORMAT_VERSION = 1
+
+try:
+    _PACKAGE_VERSION = version("faster_outlines")
+except PackageNotFoundError:
+    # Running from a source checkout.
+    _PACKAGE_VERSION = "dev"
+
+
+def cache_key(pattern: str, vocabulary_hash: int, reduce_vocabulary: bool) -> str:
+    """Content address of the index of `pattern` over a vocabulary."""
+    return blake2b(
+        f"{FORMAT_VERSION}:{_PACKAGE_VERSION}:{vocabulary_hash}:{int(reduce_vocabulary)}:{pattern}".encode(),
+        digest_size=16,
+    ).hexdigest()
+
+
+def _path(key: str) -> str:
+    return os.path.join(DISK_CACHE_DIR, f"{key}.fsm")
+
+
+def load(key: str, vocab_size: int) -> Optional[LazyFSMIndex]:
+    """The index stored under `key`, or `None` if there is none ( or it is unreadable, or
+    over more than `vocab_size` token ids )."""
+    try:
+        return LazyFSMIndex.load(_path(key), vocab_size)
+    except (OSError, ValueError):
+        return None
+
+
+def _store(key: str, lazy_fsm_index: LazyFSMIndex):
+    path = _path(key)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(DISK_CACHE_DIR, exist_ok=True)
+        # Exclusively created, then renamed over the final path in one step, so readers
+        # never see a partial index and concurrent writers never share a file.
+        os.close(os.open(tmp_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+        lazy_fsm_index.save(tmp_path)
+        os.replace(tmp_path, path)
+    except OSError:
+        # The disk cache is best effort, the index itself is still usable.
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def store(key: str, lazy_fsm_index: LazyFSMIndex):
+    """Persist `lazy_fsm_index` under `key` once it is fully computed, on a background thread."""
+    threading.Thread(target=_store, args=(key, lazy_fsm_index), daemon=True).start()
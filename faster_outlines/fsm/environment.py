@@ -0,0 +1,50 @@
+# Python side of the environment configuration.
+# Mirrors `fsm_utils/src/environment.rs`, so both caches follow the same variables.
+import os
+
+
+def _env_flag(name: str) -> bool:
+    return os.environ.get(name, "").lower() in ("1", "true", "yes")
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ[name])
+    except (KeyError, ValueError):
+        return default
+
+
+FSM_CACHE_SIZE = _env_int("FASTER_OUTLINES_CACHE_SIZE", 100)
+
+DISABLE_CACHE = _env_flag("FASTER_OUTLINES_DISABLE_CACHE")
+
+# Python only: skip loading the rust extension when `faster_outlines` is imported.
+NO_WARMUP = _env_flag("FASTER_OUTLINES_NO_WARMUP")
+
+
+def _disk_cache_dir():
+    value = os.environ.get("FASTER_OUTLINES_DISK_CACHE_DIR", "")
+    if value.lower() in ("0", "false", "no", "off"):
+        return None
+    if value.lower() in ("1", "true", "yes"):
+        cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join("~", ".cache")
+        value = os.path.join(cache_home, "faster_outlines")
+    return os.path.expanduser(value) or None
+
+
+# Python only: number of states whose allowed tokens a new `RegexGuide` computes on a
+# background thread, breadth first from the initial state. 0 ( the default ) disables it.
+PREFETCH_STATES = _env_int("FASTER_OUTLINES_PREFETCH_STATES", 0)
+
+# Python only: device the prefetched tensors are put on. Unset ( the default ) selects the
+# current CUDA device when there is one, the CPU otherwise.
+PREFETCH_DEVICE = os.environ.get("FASTER_OUTLINES_PREFETCH_DEVICE") or None
+
+# Python only: number of allowed token tensors ( and, separately, of vocabulary sized logits
+# masks ) pooled across guides, least recently used ones are dropped first.
+MASK_CACHE_SIZE = _env_int("FASTER_OUTLINES_MASK_CACHE_SIZE", 256)
+
+# Python only: directory where computed FSM indexes are persisted across processes.
+# A true flag value selects `$XDG_CACHE_HOME/faster_outlines`, a false one or unset ( the
+# default ) disables it.
+DISK_CACHE_DIR = _disk_cache_dir()
@@ -3,9 +3,11 @@ use std::collections::hash_map::DefaultHasher;
 use std::sync::{Arc, Mutex};
 use once_cell::sync::Lazy;
 use lru::LruCache;
-use rustc_hash::FxHashMap;
+use pyo3::prelude::*;
 
-use crate::types::TokenVocabulary;
+use rustc_hash::{FxHashMap, FxHashSet};
+
+use crate::types::{StateTransitionsMap, TokenVocabulary, VocabTrie};
 use crate::environment::{FSM_CACHE_SIZE, DISABLE_CACHE};
 
 
@@ -16,14 +18,24 @@ use crate::environment::{FSM_CACHE_SIZE, DISABLE_CACHE};
 ///     3. Hash both length and hash of first 1k tokens together to get a combined hash.
 /// 
 /// This takes only 1-2ms, where hashing the whole vocab of 128k tokens can take up to 128ms ( 0.128 sec )
-pub fn hash_token_vocabulary(vocabulary: &TokenVocabulary, pattern: &str) -> u64 {
+///
+/// The vocabulary part is `vocab_fingerprint`, computed once per index creation, or taken
+/// from python when the tokenizer already has a hash of its own.
+pub fn hash_token_vocabulary(vocab_fingerprint: u64, pattern: &str) -> u64 {
     let mut hasher = DefaultHasher::new();
 
+    vocab_fingerprint.hash(&mut hasher);
+    pattern.hash(&mut hasher);
 
-    vocabulary.len().hash(&mut hasher);
+    hasher.finish()
+}
 
+/// The vocabulary part of `hash_token_vocabulary`, see there.
+pub fn vocabulary_fingerprint(vocabulary: &TokenVocabulary) -> u64 {
+    let mut hasher = DefaultHasher::new();
 
-    pattern.hash(&mut hasher);
+
+    vocabulary.len().hash(&mut hasher);
 
 
     let mut entries: Vec<(&String, &Vec<u32>)> = vocabulary.iter().collect();
@@ -46,21 +58,38 @@ pub fn hash_token_vocabulary(vocabulary: &TokenVocabulary, pattern: &str) -> u64
 
 
 pub(crate) struct CachedFSM {
-    pub states_to_token_maps: Vec<FxHashMap<u32,u32>>,
+    pub states_to_token_maps: StateTransitionsMap,
     pub first_state: u32,
     pub finals: Vec<u32>
 }
 
+/// Number of vocabulary tries kept around. A trie only depends on the vocabulary and the
+/// alphabet of the FSM, so patterns over the same characters ( digits, JSON, ... ) share one.
+const VOCAB_TRIE_CACHE_SIZE: usize = 4;
+
 pub(crate) struct ModuleState {
     pub fsm_cache: Mutex<LruCache<u64, Arc<CachedFSM>>>,
+    pub vocab_trie_cache: Mutex<LruCache<u64, Arc<VocabTrie>>>,
 }
 
 pub(crate) static MODULE_STATE: Lazy<ModuleState> = Lazy::new(|| {
     ModuleState {
         fsm_cache: Mutex::new(LruCache::new(std::num::NonZeroUsize::new(*FSM_CACHE_SIZE).unwrap())),
+        vocab_trie_cache: Mutex::new(LruCache::new(
+            std::num::NonZeroUsize::new(VOCAB_TRIE_CACHE_SIZE).unwrap(),
+        )),
     }
 });
 
+/// Drop every cached FSM index and vocabulary trie.
+#[pyfunction(name = "clear_fsm_cache")]
+pub fn clear_fsm_cache_py(py: Python<'_>) {
+    py.allow_threads(|| {
+        MODULE_STATE.fsm_cache.lock().unwrap().clear();
+        MODULE_STATE.vocab_trie_cache.lock().unwrap().clear();
+    })
+}
+
 pub fn get_cached_fsm(hash: u64) -> Option<Arc<CachedFSM>> {
     if *DISABLE_CACHE {
         return None;
@@ -73,3 +102,49 @@ pub fn get_cached_fsm(hash: u64) -> Option<Arc<CachedFSM>> {
         None
     }
 }
+
+/// Key of the vocabulary trie built for an FSM: the vocabulary, the alphabet mapping the
+/// characters of tokens to transition keys, and, when dead tokens are removed, the set of
+/// transition keys the FSM actually uses.
+pub fn hash_vocab_trie_key(
+    vocab_fingerprint: u64,
+    alphabet_symbol_mapping: &FxHashMap<String, u32>,
+    alphabet_anything_value: u32,
+    live_keys: Option<&FxHashSet<u32>>,
+) -> u64 {
+    let mut hasher = DefaultHasher::new();
+
+    vocab_fingerprint.hash(&mut hasher);
+    alphabet_anything_value.hash(&mut hasher);
+
+    let mut symbols: Vec<(&String, &u32)> = alphabet_symbol_mapping.iter().collect();
+    symbols.sort_unstable();
+    symbols.hash(&mut hasher);
+
+    if let Some(live_keys) = live_keys {
+        let mut live_keys: Vec<u32> = live_keys.iter().copied().collect();
+        live_keys.sort_unstable();
+        live_keys.hash(&mut hasher);
+    }
+
+    hasher.finish()
+}
+
+pub fn get_or_create_vocab_trie(key: u64, create: impl FnOnce() -> VocabTrie) -> Arc<VocabTrie> {
+    if *DISABLE_CACHE {
+        return Arc::new(create());
+    }
+
+    if let Some(vocab_trie) = MODULE_STATE.vocab_trie_cache.lock().unwrap().get(&key) {
+        return Arc::clone(vocab_trie);
+    }
+
+    // Built without holding the lock, so FSMs with other alphabets are not held up.
+    let vocab_trie = Arc::new(create());
+    MODULE_STATE
+        .vocab_trie_cache
+        .lock()
+        .unwrap()
+        .put(key, Arc::clone(&vocab_trie));
+    vocab_trie
+}
@@ -1,4 +1,5 @@
 use std::env;
+use std::thread;
 use once_cell::sync::Lazy;
 
 pub static FSM_CACHE_SIZE: Lazy<usize> = Lazy::new(|| {
@@ -14,7 +15,12 @@ pub static NUM_THREADS: Lazy<String> = Lazy::new(|| {
             println!("Faster Outlines num threads set to: {:?}", threads);
             threads
         },
-        Err(_) => "1".to_string(),
+        // Leave one core free so the thread driving generation (and waiting on
+        // state notifiers) stays responsive while the index is being built.
+        Err(_) => thread::available_parallelism()
+            .map(|n| n.get().saturating_sub(1).max(1))
+            .unwrap_or(1)
+            .to_string(),
     }
 });
 
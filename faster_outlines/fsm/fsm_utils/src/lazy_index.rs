@@ -1,18 +1,38 @@
 use pyo3::prelude::*;
-use pyo3::{exceptions::PyKeyError, types::PyDict};
+use pyo3::{
+    exceptions::{PyIOError, PyKeyError, PyValueError},
+    types::{PyByteArray, PyBytes, PyDict, PyType},
+};
 
 use rustc_hash::FxHashMap;
 
+use std::collections::BTreeMap;
+use std::fs;
+use std::path::PathBuf;
 use std::sync::{Arc, Condvar, Mutex};
 
 use std::thread;
+use std::time::Instant;
 
 use crate::{
     tokenizer_index::create_fsm_index_end_to_end_parallel,
-    types::{FSMInfo, TokenVocabulary, ThreadSafeCell},
-    caching::{get_cached_fsm, MODULE_STATE, CachedFSM, hash_token_vocabulary}
+    types::{vocabulary_size, FSMInfo, StateTransitions, StateTransitionsMap, TokenVocabulary, ThreadSafeCell},
+    caching::{get_cached_fsm, MODULE_STATE, CachedFSM, hash_token_vocabulary, vocabulary_fingerprint}
 };
 
+/// Bumped whenever the layout produced by `LazyFSMIndex::serialize` changes.
+const SERIALIZATION_VERSION: u32 = 1;
+
+/// One step of the splitmix64 generator: advances `rng_state` and returns a random word.
+#[inline(always)]
+fn splitmix64(rng_state: &mut u64) -> u64 {
+    *rng_state = rng_state.wrapping_add(0x9E3779B97F4A7C15);
+    let mut z = *rng_state;
+    z = (z ^ (z >> 30)).wrapping_mul(0xBF58476D1CE4E5B9);
+    z = (z ^ (z >> 27)).wrapping_mul(0x94D049BB133111EB);
+    z ^ (z >> 31)
+}
+
 pub(crate) type StateNotifierMap = Arc<Vec<Arc<(Mutex<bool>, Condvar)>>>;
 
 /// Write instruction.
@@ -89,13 +109,14 @@ impl IntoPy<PyObject> for Instruction {
     }
 }
 
-#[pyclass]
+// The module path is needed for pickle to find the class again.
+#[pyclass(module = "faster_outlines.fsm.fsm_utils")]
 #[derive(Clone, Debug)]
 pub struct LazyFSMIndex {
     /// the mapping of states to token subsets from the tokenizer.
     /// this is an interpreted version of the FSM info.
     /// interpreted according to the token vocabulary.
-    states_to_token_maps: Arc<Vec<ThreadSafeCell<FxHashMap<u32, u32>>>>,
+    states_to_token_maps: StateTransitionsMap,
 
     /// First state of the FSM
     first_state: u32,
@@ -103,7 +124,11 @@ pub struct LazyFSMIndex {
     /// The end-of-sequence token ID from tokenizer.
     eos_token_id: u32,
 
+    /// Number of token ids in the vocabulary, i.e. the length of the allowed token bitmaps.
+    vocab_size: usize,
+
     // the final states of the fsm
+    #[pyo3(get)]
     finals: Vec<u32>,
 
     // for notifying waiters when a state is finished.
@@ -111,7 +136,8 @@ pub struct LazyFSMIndex {
 
     /// bool indicator, just so we dont need to manually iterate
     /// over the notifiers to check if they are all finished.
-    computing_finished: Arc<Mutex<bool>>,
+    /// The condvar is notified once every state has been computed.
+    computing_finished: Arc<(Mutex<bool>, Condvar)>,
 }
 
 /// We gate the creation of new indexes in a impl block seperate to that of the definition
@@ -119,40 +145,34 @@ pub struct LazyFSMIndex {
 /// `create_fsm_index_end_to_end_py` function interfaced to python.
 
 impl LazyFSMIndex {
-    pub fn new(fsm_info: FSMInfo, vocabulary: TokenVocabulary, eos_token_id: u32) -> Self {
-
-        let cache_key = hash_token_vocabulary(&vocabulary, &fsm_info.pattern);
+    pub fn new(
+        fsm_info: FSMInfo,
+        vocabulary: Arc<TokenVocabulary>,
+        eos_token_id: u32,
+        reduce_vocabulary: bool,
+        vocab_hash: Option<u64>,
+    ) -> Self {
+
+        let vocab_fingerprint = vocab_hash.unwrap_or_else(|| vocabulary_fingerprint(&vocabulary));
+        let cache_key = hash_token_vocabulary(vocab_fingerprint, &fsm_info.pattern);
+        let vocab_size = vocabulary_size(&vocabulary, eos_token_id);
 
         let cache_entry = {
             get_cached_fsm(cache_key)
         };
 
         if let Some(cached_fsm) = cache_entry {
-            let states_to_token_maps: Arc<Vec<ThreadSafeCell<FxHashMap<u32,u32>>>> = Arc::new(
-                cached_fsm.states_to_token_maps
-                    .iter()
-                    .map(|map| ThreadSafeCell::new(map.clone()))
-                    .collect()
-            );
-
-            let state_notifiers = Arc::new(
-                (0..states_to_token_maps.len())
-                    .map(|_| Arc::new((Mutex::new(true), Condvar::new())))
-                    .collect()
-            );
-
-            LazyFSMIndex {
-                states_to_token_maps,
-                first_state: cached_fsm.first_state,
+            LazyFSMIndex::from_computed(
+                Arc::clone(&cached_fsm.states_to_token_maps),
+                cached_fsm.first_state,
                 eos_token_id,
-                finals: cached_fsm.finals.clone(),
-                computing_finished: Arc::new(Mutex::new(true)),
-                state_notifiers,
-            }
+                vocab_size,
+                cached_fsm.finals.clone(),
+            )
         } else {
             let results = Arc::new(
                 (0..fsm_info.states.len())
-                    .map(|_| ThreadSafeCell::new(FxHashMap::default()))
+                    .map(|_| ThreadSafeCell::new(StateTransitions::default()))
                     .collect::<Vec<_>>(),
             );
 
@@ -163,7 +183,7 @@ impl LazyFSMIndex {
             );
 
             let state_notifiers_clone = Arc::clone(&state_notifiers);
-            let computing_finished = Arc::new(Mutex::new(false));
+            let computing_finished = Arc::new((Mutex::new(false), Condvar::new()));
             let computing_finished_clone = Arc::clone(&computing_finished);
             let results_clone = Arc::clone(&results);
             let first_state = fsm_info.initial;
@@ -177,15 +197,14 @@ impl LazyFSMIndex {
                 create_fsm_index_end_to_end_parallel(
                     &fsm_info,
                     &vocabulary,
+                    vocab_fingerprint,
                     &results_clone,
                     &state_notifiers_clone,
+                    reduce_vocabulary,
                 );
 
                 let cached_fsm = CachedFSM {
-                    states_to_token_maps: results_clone
-                        .iter()
-                        .map(|cell| unsafe { &*cell.get_ref() }.clone())
-                        .collect(),
+                    states_to_token_maps: results_clone,
                     first_state,
                     finals: finals_clone.to_vec(), 
                 };
@@ -193,13 +212,16 @@ impl LazyFSMIndex {
                 let mut cache = MODULE_STATE.fsm_cache.lock().unwrap();
                 cache.put(cache_key_clone, Arc::new(cached_fsm));
 
-                *computing_finished_clone.lock().unwrap() = true;
+                let (finished_lock, condvar) = &*computing_finished_clone;
+                *finished_lock.lock().unwrap() = true;
+                condvar.notify_all();
             });
             let finals = finals.to_vec();
             LazyFSMIndex {
                 states_to_token_maps: results,
                 first_state,
                 eos_token_id,
+                vocab_size,
                 finals, 
                 computing_finished,
                 state_notifiers,
@@ -207,7 +229,118 @@ impl LazyFSMIndex {
         }
     }
 
-    pub fn get_state_map(&self, state: u32) -> Option<FxHashMap<u32, u32>> {
+    /// Build an index whose states are all already computed.
+    fn from_computed(
+        states_to_token_maps: StateTransitionsMap,
+        first_state: u32,
+        eos_token_id: u32,
+        vocab_size: usize,
+        finals: Vec<u32>,
+    ) -> Self {
+        let state_notifiers = Arc::new(
+            (0..states_to_token_maps.len())
+                .map(|_| Arc::new((Mutex::new(true), Condvar::new())))
+                .collect()
+        );
+
+        LazyFSMIndex {
+            states_to_token_maps,
+            first_state,
+            eos_token_id,
+            vocab_size,
+            finals,
+            computing_finished: Arc::new((Mutex::new(true), Condvar::new())),
+            state_notifiers,
+        }
+    }
+
+    /// Serialize the index into a flat buffer of little-endian `u32` words:
+    ///
+    /// `[version, first_state, eos_token_id, vocab_size, n_finals, finals..., n_states,
+    ///   (n_transitions, token_ids..., next_states...) for each state]`
+    ///
+    /// Blocks until every state has been computed.
+    pub fn serialize(&self) -> Vec<u8> {
+        self.wait_until_finished();
+
+        let mut words = vec![
+            SERIALIZATION_VERSION,
+            self.first_state,
+            self.eos_token_id,
+            self.vocab_size as u32,
+            self.finals.len() as u32,
+        ];
+        words.extend_from_slice(&self.finals);
+        words.push(self.states_to_token_maps.len() as u32);
+        for cell in self.states_to_token_maps.iter() {
+            let transitions = unsafe { cell.get_ref() };
+            words.push(transitions.len() as u32);
+            words.extend_from_slice(&transitions.token_ids);
+            words.extend_from_slice(&transitions.next_states);
+        }
+
+        words.iter().flat_map(|word| word.to_le_bytes()).collect()
+    }
+
+    /// Inverse of `serialize`. Returns `None` if `data` is not a valid serialized index, or
+    /// if its vocabulary is larger than `max_vocab_size`, the vocabulary it is loaded for.
+    ///
+    /// `data` may come from a corrupt or stale file, so every id in it is checked to be in
+    /// range: it is trusted as is once loaded.
+    pub fn deserialize(data: &[u8], max_vocab_size: Option<usize>) -> Option<Self> {
+        if data.len() % 4 != 0 {
+            return None;
+        }
+        let mut words = data
+            .chunks_exact(4)
+            .map(|chunk| u32::from_le_bytes([chunk[0], chunk[1], chunk[2], chunk[3]]));
+        let mut read_words = |n: usize| -> Option<Vec<u32>> {
+            let read: Vec<u32> = words.by_ref().take(n).collect();
+            (read.len() == n).then_some(read)
+        };
+
+        let header = read_words(5)?;
+        if header[0] != SERIALIZATION_VERSION {
+            return None;
+        }
+        let (first_state, eos_token_id, vocab_size) = (header[1], header[2], header[3] as usize);
+        if eos_token_id as usize >= vocab_size || max_vocab_size.is_some_and(|max| vocab_size > max) {
+            return None;
+        }
+        let finals = read_words(header[4] as usize)?;
+
+        let n_states = read_words(1)?[0] as usize;
+        let in_states = |state: &u32| (*state as usize) < n_states;
+        if !in_states(&first_state) || !finals.iter().all(in_states) {
+            return None;
+        }
+
+        let mut states_to_token_maps = Vec::with_capacity(n_states.min(data.len() / 4));
+        for _ in 0..n_states {
+            let n_transitions = read_words(1)?[0] as usize;
+            let token_ids = read_words(n_transitions)?;
+            let next_states = read_words(n_transitions)?;
+            // Rows are written in token id order, so they are rebuilt without sorting.
+            let in_order = token_ids.windows(2).all(|pair| pair[0] < pair[1]);
+            if !in_order
+                || token_ids.last().is_some_and(|&token_id| token_id as usize >= vocab_size)
+                || !next_states.iter().all(in_states)
+            {
+                return None;
+            }
+            states_to_token_maps.push(ThreadSafeCell::new(StateTransitions::from_sorted(token_ids, next_states)));
+        }
+
+        Some(LazyFSMIndex::from_computed(
+            Arc::new(states_to_token_maps),
+            first_state,
+            eos_token_id,
+            vocab_size,
+            finals,
+        ))
+    }
+
+    pub fn get_state_map(&self, state: u32) -> Option<&StateTransitions> {
         // Check if the state index is valid
         if state as usize >= self.states_to_token_maps.len() {
             return None;
@@ -228,10 +361,73 @@ impl LazyFSMIndex {
             done = cvar.wait(done).unwrap();
         }
 
-        // Now it's safe to read from the HashMap
+        // Now it's safe to read the transitions, they are never written again.
         let cell = &self.states_to_token_maps[state as usize];
-        let map = unsafe { &*cell.get_ref() };
-        Some(map.clone())
+        Some(unsafe { cell.get_ref() })
+    }
+
+    /// Wait for `state` to be computed with the GIL released. The GIL is left alone when the
+    /// state is already available, which is the common case once generation is underway.
+    fn wait_for_state_without_gil(&self, py: Python<'_>, state: u32) {
+        if let Some(notifier) = self.state_notifiers.get(state as usize) {
+            if !*notifier.0.lock().unwrap() {
+                py.allow_threads(|| {
+                    self.get_state_map(state);
+                });
+            }
+        }
+    }
+
+    /// Block until every state has been computed.
+    fn wait_until_finished(&self) {
+        let (finished_lock, condvar) = &*self.computing_finished;
+        let mut finished = finished_lock.lock().unwrap();
+        while !*finished {
+            finished = condvar.wait(finished).unwrap();
+        }
+    }
+
+    /// The transitions of `state` as a python dict, `None` for states outside the index.
+    /// Waits for the state with the GIL released, and builds the dict with the GIL token
+    /// the caller already holds.
+    fn state_dict<'py>(&self, py: Python<'py>, state: u32) -> PyResult<Option<Bound<'py, PyDict>>> {
+        self.wait_for_state_without_gil(py, state);
+        match self.get_state_map(state) {
+            Some(transitions) => {
+                let py_dict = PyDict::new_bound(py);
+                for (token_id, next_state) in transitions.iter() {
+                    py_dict.set_item(token_id, next_state)?;
+                }
+                Ok(Some(py_dict))
+            }
+            None => Ok(None),
+        }
+    }
+
+    /// Follow the chain of states which only allow a single token, starting at `state`.
+    /// The walk stops at the first state with more ( or no ) allowed tokens, after reaching
+    /// a final state, or once it is as long as the number of states, so single-token
+    /// cycles terminate. Every state of the walk is waited for with the GIL released.
+    pub fn forced_tokens(&self, py: Python<'_>, state: u32) -> Vec<i32> {
+        let mut tokens = Vec::new();
+        let mut current_state = state;
+
+        while tokens.len() < self.states_to_token_maps.len() {
+            self.wait_for_state_without_gil(py, current_state);
+            let (token_id, next_state) = match self.get_state_map(current_state) {
+                Some(transitions) if transitions.len() == 1 => {
+                    (transitions.token_ids[0], transitions.next_states[0])
+                }
+                _ => break,
+            };
+            tokens.push(token_id as i32);
+            if self.finals.contains(&next_state) {
+                break;
+            }
+            current_state = next_state;
+        }
+
+        tokens
     }
 }
 
@@ -243,7 +439,7 @@ impl LazyFSMIndex {
 ///     and the `HashMap` python api, (.get(key), indexing)
 #[pymethods]
 impl LazyFSMIndex {
-    pub fn get_next_state(&self, state: i32, token_id: u32) -> Option<i32> {
+    pub fn get_next_state(&self, py: Python<'_>, state: i32, token_id: u32) -> Option<i32> {
         // check if they are alias states first ( -1, or 0 )
         // state 0 is alias for the first state
         // -1 alias for the last state.
@@ -263,9 +459,11 @@ impl LazyFSMIndex {
             state as u32
         };
 
+        self.wait_for_state_without_gil(py, current_state);
+
         // Attempt to find the next state using the get_state_map method
         self.get_state_map(current_state)
-            .and_then(|map| map.get(&token_id).copied().map(|s| s as i32))
+            .and_then(|transitions| transitions.next_state(token_id).map(|s| s as i32))
             .map(|next_state| {
                 // If the next state is final, return -1
                 if self.is_final_state(next_state) {
@@ -278,19 +476,33 @@ impl LazyFSMIndex {
             .or(Some(-1))
     }
 
-    pub fn get_next_instruction(&self, state: i32) -> Instruction {
+    /// With `jump_forward`, states that only allow a single token return a `Write` of the
+    /// whole forced token sequence instead of a one-token `Generate`, so the caller can
+    /// append it at once. The caller is still expected to advance the state token by token
+    /// with `get_next_state`.
+    #[pyo3(signature = (state, jump_forward = false))]
+    pub fn get_next_instruction(&self, py: Python<'_>, state: i32, jump_forward: bool) -> Instruction {
         if self.is_final_state(state) {
             return Instruction::Write {
                 write: Write::new(vec![self.eos_token_id as i32]),
             };
         } else {
+            self.wait_for_state_without_gil(py, state as u32);
+            if jump_forward {
+                let forced = self.forced_tokens(py, state as u32);
+                if !forced.is_empty() {
+                    return Instruction::Write {
+                        write: Write::new(forced),
+                    };
+                }
+            }
             match self.get_state_map(state as u32) {
                 Some(next_tokens_to_end_states) => {
-                    // Collect all keys (token IDs) from the map and convert them to i32
+                    // Collect all token IDs allowed from this state and convert them to i32
                     let allowed = next_tokens_to_end_states
-                        .keys()
-                        .cloned()
-                        .map(|k| k as i32)
+                        .token_ids
+                        .iter()
+                        .map(|&k| k as i32)
                         .collect::<Vec<i32>>();
                     return Instruction::Generate {
                         generate: Generate::new(Some(allowed)),
@@ -315,65 +527,285 @@ impl LazyFSMIndex {
     }
 
     pub fn is_computing_finished(&self) -> bool {
-        *self.computing_finished.lock().unwrap()
+        *self.computing_finished.0.lock().unwrap()
     }
+
+    /// Block until every state has been computed. The GIL is released while waiting,
+    /// so other python threads keep running.
+    pub fn await_finished(&self, py: Python<'_>) {
+        py.allow_threads(|| self.wait_until_finished())
+    }
+
     /// NOTE: THIS IS NOT VERY PERFORMANT!
-    pub fn get_states_to_token_subsets(&self) -> FxHashMap<u32, FxHashMap<u32, u32>> {
-        while !self.is_computing_finished() {
-            thread::sleep(std::time::Duration::from_millis(2));
-        }
+    pub fn get_states_to_token_subsets(&self, py: Python<'_>) -> FxHashMap<u32, FxHashMap<u32, u32>> {
+        self.await_finished(py);
 
         self.states_to_token_maps
             .iter()
             .enumerate()
             .map(|(index, cell)| {
-                let map = unsafe { &*cell.get_ref() };
-                (index as u32, map.clone())
+                let transitions = unsafe { cell.get_ref() };
+                (index as u32, transitions.iter().collect())
             })
             .collect()
     }
 
-    pub fn allowed_token_ids(&self, state: i32) -> Vec<i32> {
+    /// Number of states in the FSM.
+    pub fn n_states(&self) -> usize {
+        self.states_to_token_maps.len()
+    }
+
+    /// Total number of `(state, token) -> state` transitions, once every state is computed.
+    pub fn n_transitions(&self, py: Python<'_>) -> usize {
+        self.await_finished(py);
+
+        self.states_to_token_maps
+            .iter()
+            .map(|cell| unsafe { cell.get_ref() }.len())
+            .sum()
+    }
+
+    pub fn allowed_token_ids(&self, py: Python<'_>, state: i32) -> Vec<i32> {
         if state == -1 {
             return vec![self.eos_token_id as i32];
         }
+        self.wait_for_state_without_gil(py, state as u32);
         match self.get_state_map(state as u32) {
             Some(next_tokens_to_end_states) => {
-                // Collect all keys (token IDs) from the map and convert them to i32
+                // Collect all token IDs allowed from this state and convert them to i32
                 next_tokens_to_end_states
-                    .keys()
-                    .cloned()
-                    .map(|k| k as i32)
+                    .token_ids
+                    .iter()
+                    .map(|&k| k as i32)
                     .collect()
             }
             None => return vec![self.eos_token_id as i32],
         }
     }
 
-    fn get(&self, state: u32, default: Option<PyObject>) -> PyResult<PyObject> {
-        Python::with_gil(|py| {
-            match self.get_state_map(state) {
-                Some(map) => {
-                    // Convert the HashMap to a Python dict
-                    let py_dict = PyDict::new_bound(py);
-                    for (k, v) in map.iter() {
-                        py_dict.set_item(*k, *v)?;
+    /// Same as `allowed_token_ids`, as a buffer of little-endian `i32`s to be viewed with
+    /// `np.frombuffer(buffer, dtype="<i4")`. It is a `bytearray`, so the resulting array is
+    /// writable and can back a tensor without another copy.
+    pub fn allowed_token_ids_buffer<'py>(&self, py: Python<'py>, state: i32) -> PyResult<Bound<'py, PyByteArray>> {
+        let eos_only = [self.eos_token_id];
+        let token_ids: &[u32] = if state == -1 {
+            &eos_only
+        } else {
+            self.wait_for_state_without_gil(py, state as u32);
+            match self.get_state_map(state as u32) {
+                Some(transitions) => &transitions.token_ids,
+                None => &eos_only,
+            }
+        };
+
+        PyByteArray::new_bound_with(py, token_ids.len() * 4, |buffer| {
+            for (chunk, &token_id) in buffer.chunks_exact_mut(4).zip(token_ids) {
+                chunk.copy_from_slice(&(token_id as i32).to_le_bytes());
+            }
+            Ok(())
+        })
+    }
+
+    /// The tokens `forced_tokens` would force from `state`, empty for final states or states
+    /// allowing more than one token. Unlike `get_next_instruction(state, jump_forward=True)`,
+    /// the result is never an EOS stand-in.
+    pub fn get_forced_tokens(&self, py: Python<'_>, state: i32) -> Vec<i32> {
+        if self.is_final_state(state) {
+            return Vec::new();
+        }
+        self.forced_tokens(py, state as u32)
+    }
+
+    /// The distinct states reachable from `state` in one token, in increasing order, as
+    /// `get_next_state` would return them. Final states are omitted, they are all `-1`.
+    pub fn next_states(&self, py: Python<'_>, state: i32) -> Vec<i32> {
+        if self.is_final_state(state) {
+            return Vec::new();
+        }
+        self.wait_for_state_without_gil(py, state as u32);
+        let mut next_states: Vec<i32> = match self.get_state_map(state as u32) {
+            Some(transitions) => transitions
+                .next_states
+                .iter()
+                .map(|&next_state| next_state as i32)
+                .filter(|&next_state| !self.is_final_state(next_state))
+                .collect(),
+            None => Vec::new(),
+        };
+        next_states.sort_unstable();
+        next_states.dedup();
+        next_states
+    }
+
+    /// Draw one of the tokens allowed in `state` uniformly at random, without building
+    /// the list of allowed tokens. Returns the token and the advanced `rng_state`, to be
+    /// passed to the next call. Final and unknown states only allow EOS.
+    pub fn sample_allowed_token(&self, py: Python<'_>, state: i32, rng_state: u64) -> (i32, u64) {
+        let mut rng_state = rng_state;
+        if self.is_final_state(state) {
+            return (self.eos_token_id as i32, rng_state);
+        }
+        self.wait_for_state_without_gil(py, state as u32);
+        match self.get_state_map(state as u32) {
+            Some(transitions) if !transitions.is_empty() => {
+                // Multiply-shift maps the random word onto 0..len without a modulo.
+                let idx = ((splitmix64(&mut rng_state) as u128 * transitions.len() as u128) >> 64) as usize;
+                (transitions.token_ids[idx] as i32, rng_state)
+            }
+            _ => (self.eos_token_id as i32, rng_state),
+        }
+    }
+
+    /// Benchmark helper: take `n_steps` random transitions starting from the first state,
+    /// going back to it whenever a final state or a dead end is reached. Returns the number
+    /// of transitions taken and the time it took in nanoseconds, measured on the rust side.
+    #[pyo3(signature = (n_steps, seed = 0))]
+    pub fn run_random_walk(&self, py: Python<'_>, n_steps: u64, seed: u64) -> (u64, u64) {
+        py.allow_threads(|| {
+            let start = Instant::now();
+            let mut rng_state = seed;
+            let mut state = self.first_state;
+            let mut num_instructions = 0u64;
+
+            for _ in 0..n_steps {
+                let transitions = match self.get_state_map(state) {
+                    Some(transitions) if !transitions.is_empty() && !self.finals.contains(&state) => {
+                        transitions
                     }
-                    Ok(py_dict.to_object(py))
-                }
-                None => match default {
-                    Some(default_value) => Ok(default_value),
-                    None => Ok(py.None()),
-                },
+                    _ => {
+                        state = self.first_state;
+                        continue;
+                    }
+                };
+                let idx = ((splitmix64(&mut rng_state) as u128 * transitions.len() as u128) >> 64) as usize;
+                state = transitions.next_states[idx];
+                num_instructions += 1;
             }
+
+            (num_instructions, start.elapsed().as_nanos() as u64)
         })
     }
 
-    ///* Python Magic methods *///
-    pub fn __repr__(&self) -> PyResult<String> {
-        while !self.is_computing_finished() {
-            thread::sleep(std::time::Duration::from_millis(100));
+    /// Bitmap of the tokens allowed in `state`, as little-endian `u64` words.
+    /// Bit `i % 64` of word `i / 64` is set when token `i` is allowed, so python
+    /// callers can view it without a copy through `np.frombuffer(bitmap, dtype="<u8")`.
+    pub fn get_allowed_bitmap<'py>(&self, py: Python<'py>, state: i32) -> PyResult<Bound<'py, PyBytes>> {
+        let words: Vec<u64> = if self.is_final_state(state) {
+            let mut bitmap = vec![0u64; self.vocab_size.div_ceil(64)];
+            bitmap[self.eos_token_id as usize / 64] |= 1 << (self.eos_token_id % 64);
+            bitmap
+        } else {
+            self.wait_for_state_without_gil(py, state as u32);
+            match self.get_state_map(state as u32) {
+                Some(transitions) => transitions.allowed_bitmap(self.vocab_size),
+                None => return Err(PyKeyError::new_err(format!("State {} not found", state))),
+            }
+        };
+
+        PyBytes::new_bound_with(py, words.len() * 8, |buffer| {
+            for (chunk, word) in buffer.chunks_exact_mut(8).zip(&words) {
+                chunk.copy_from_slice(&word.to_le_bytes());
+            }
+            Ok(())
+        })
+    }
+
+    /// The whole transition table in CSR layout, as three buffers of little-endian `u32`s
+    /// ( view them with `np.frombuffer(buffer, dtype="<u4")` ):
+    ///  - `row_offsets`: the transitions of state `s` are at `row_offsets[s]..row_offsets[s + 1]`.
+    ///  - `token_ids`: the token of each transition, sorted within a state.
+    ///  - `next_states`: the state each transition leads to.
+    ///
+    /// Blocks until every state has been computed.
+    pub fn transitions_csr<'py>(
+        &self,
+        py: Python<'py>,
+    ) -> (Bound<'py, PyBytes>, Bound<'py, PyBytes>, Bound<'py, PyBytes>) {
+        let (row_offsets, token_ids, next_states) = py.allow_threads(|| {
+            self.wait_until_finished();
+
+            let mut row_offsets = Vec::with_capacity(self.states_to_token_maps.len() + 1);
+            let mut token_ids = Vec::new();
+            let mut next_states = Vec::new();
+            row_offsets.push(0u32);
+            for cell in self.states_to_token_maps.iter() {
+                let transitions = unsafe { cell.get_ref() };
+                token_ids.extend_from_slice(&transitions.token_ids);
+                next_states.extend_from_slice(&transitions.next_states);
+                row_offsets.push(token_ids.len() as u32);
+            }
+            (row_offsets, token_ids, next_states)
+        });
+
+        let to_bytes = |words: Vec<u32>| -> Vec<u8> {
+            words.iter().flat_map(|word| word.to_le_bytes()).collect()
+        };
+        (
+            PyBytes::new_bound(py, &to_bytes(row_offsets)),
+            PyBytes::new_bound(py, &to_bytes(token_ids)),
+            PyBytes::new_bound(py, &to_bytes(next_states)),
+        )
+    }
+
+    /// Serialize the fully computed index to bytes, see `LazyFSMIndex.from_bytes`.
+    pub fn to_bytes<'py>(&self, py: Python<'py>) -> Bound<'py, PyBytes> {
+        let data = py.allow_threads(|| self.serialize());
+        PyBytes::new_bound(py, &data)
+    }
+
+    /// Rebuild an index from the output of `to_bytes`. All of its states are already computed.
+    /// With `vocab_size`, indexes over a larger vocabulary are rejected.
+    #[classmethod]
+    #[pyo3(signature = (data, vocab_size = None))]
+    pub fn from_bytes(_cls: &Bound<'_, PyType>, data: &[u8], vocab_size: Option<usize>) -> PyResult<Self> {
+        LazyFSMIndex::deserialize(data, vocab_size)
+            .ok_or_else(|| PyValueError::new_err("Invalid serialized LazyFSMIndex"))
+    }
+
+    /// Write the fully computed index to `path`, in the same format as `to_bytes`.
+    pub fn save(&self, py: Python<'_>, path: PathBuf) -> PyResult<()> {
+        py.allow_threads(|| fs::write(&path, self.serialize()))
+            .map_err(|err| PyIOError::new_err(format!("Could not write {}: {}", path.display(), err)))
+    }
+
+    /// Read an index written by `save`. All of its states are already computed.
+    /// With `vocab_size`, indexes over a larger vocabulary are rejected.
+    #[classmethod]
+    #[pyo3(signature = (path, vocab_size = None))]
+    pub fn load(_cls: &Bound<'_, PyType>, py: Python<'_>, path: PathBuf, vocab_size: Option<usize>) -> PyResult<Self> {
+        let data = py
+            .allow_threads(|| fs::read(&path))
+            .map_err(|err| PyIOError::new_err(format!("Could not read {}: {}", path.display(), err)))?;
+        LazyFSMIndex::deserialize(&data, vocab_size).ok_or_else(|| {
+            PyValueError::new_err(format!("{} is not a serialized LazyFSMIndex", path.display()))
+        })
+    }
+
+    pub fn __reduce__<'py>(
+        &self,
+        py: Python<'py>,
+    ) -> PyResult<(Bound<'py, PyAny>, (Bound<'py, PyBytes>,))> {
+        let from_bytes = py.get_type_bound::<LazyFSMIndex>().getattr("from_bytes")?;
+        Ok((from_bytes, (self.to_bytes(py),)))
+    }
+
+    /// `{token_id: next_state}` of `state`, or `default` for states outside the index.
+    #[pyo3(signature = (state, default = None))]
+    fn get<'py>(
+        &self,
+        py: Python<'py>,
+        state: u32,
+        default: Option<Bound<'py, PyAny>>,
+    ) -> PyResult<Bound<'py, PyAny>> {
+        match self.state_dict(py, state)? {
+            Some(py_dict) => Ok(py_dict.into_any()),
+            None => Ok(default.unwrap_or_else(|| py.None().into_bound(py))),
         }
+    }
+
+    ///* Python Magic methods *///
+    pub fn __repr__(&self, py: Python<'_>) -> PyResult<String> {
+        self.await_finished(py);
 
         let states: String = self
             .states_to_token_maps
@@ -381,7 +813,7 @@ impl LazyFSMIndex {
             .take(10)
             .enumerate()
             .map(|(index, cell)| {
-                let state_map = unsafe { &*cell.get_ref() };
+                let state_map: BTreeMap<u32, u32> = unsafe { cell.get_ref() }.iter().collect();
                 format!("{}: {:?}", index, state_map)
             })
             .collect::<Vec<String>>()
@@ -406,19 +838,8 @@ impl LazyFSMIndex {
         ))
     }
 
-    fn __getitem__(&self, state: u32) -> PyResult<PyObject> {
-        Python::with_gil(|py| {
-            match self.get_state_map(state) {
-                Some(map) => {
-                    // Convert the HashMap to a Python dict
-                    let py_dict = PyDict::new_bound(py);
-                    for (k, v) in map.iter() {
-                        py_dict.set_item(*k, *v)?;
-                    }
-                    Ok(py_dict.to_object(py))
-                }
-                None => Err(PyKeyError::new_err(format!("State {} not found", state))),
-            }
-        })
+    fn __getitem__<'py>(&self, py: Python<'py>, state: u32) -> PyResult<Bound<'py, PyDict>> {
+        self.state_dict(py, state)?
+            .ok_or_else(|| PyKeyError::new_err(format!("State {} not found", state)))
     }
 }
@@ -9,10 +9,10 @@ mod types;
 mod caching;
 mod environment;
 
-use tokenizer_index::create_fsm_index_end_to_end_py;
+use tokenizer_index::{create_fsm_index_end_to_end_py, create_fsm_indices_batch_py};
 use environment::NUM_THREADS;
 use crate::lazy_index::{LazyFSMIndex, Write, Generate};
-use crate::caching::MODULE_STATE;
+use crate::caching::{clear_fsm_cache_py, MODULE_STATE};
 
 #[pymodule]
 fn fsm_utils(m: &Bound<'_, PyModule>) -> PyResult<()> {
@@ -22,6 +22,8 @@ fn fsm_utils(m: &Bound<'_, PyModule>) -> PyResult<()> {
     Lazy::force(&MODULE_STATE);
 
     m.add_function(wrap_pyfunction!(create_fsm_index_end_to_end_py, m)?)?;
+    m.add_function(wrap_pyfunction!(create_fsm_indices_batch_py, m)?)?;
+    m.add_function(wrap_pyfunction!(clear_fsm_cache_py, m)?)?;
     m.add_class::<LazyFSMIndex>()?;
     m.add_class::<Write>()?;
     m.add_class::<Generate>()?;
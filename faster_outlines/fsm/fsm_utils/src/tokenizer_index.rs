@@ -4,9 +4,11 @@ use rayon::prelude::*;
 use rustc_hash::{FxHashMap, FxHashSet};
 use std::sync::Arc;
 
-//use crate::caching::get_or_create_vocab_trie;
+use crate::caching::{get_or_create_vocab_trie, hash_vocab_trie_key, vocabulary_fingerprint};
 use crate::lazy_index::StateNotifierMap;
-use crate::types::{FSMInfo, ThreadSafeCell, TokenVocabulary};
+use crate::types::{
+    FSMInfo, StateTransitions, ThreadSafeCell, TokenVocabulary, TransitionTable, VocabTrie,
+};
 use crate::lazy_index::LazyFSMIndex;
 
 fn get_vocabulary_transition_keys(
@@ -58,72 +60,42 @@ fn get_token_transition_keys(
     token_transition_keys
 }
 
-fn walk_fsm(
-    fsm_transitions: &FxHashMap<(u32, u32), u32>,
-    _fsm_initial: u32,
-    fsm_finals: &Arc<Vec<u32>>,
-    token_transition_keys: &[u32],
-    start_state: u32,
-    full_match: bool,
-) -> Vec<u32> {
-    let mut state = start_state;
-    let mut accepted_states = Vec::new();
-    let mut last_final_idx = 0;
-
-    for (i, &trans_key) in token_transition_keys.iter().enumerate() {
-        match fsm_transitions.get(&(state, trans_key)) {
-            Some(&new_state) => {
-                state = new_state;
-                if fsm_finals.contains(&state) {
-                    last_final_idx = i + 1;
-                }
-                accepted_states.push(state);
-            }
-            None => {
-                if !full_match && last_final_idx > 0 {
-                    return accepted_states[..last_final_idx].to_vec();
-                }
-                return Vec::new();
-            }
-        }
-    }
-
-    if full_match && last_final_idx != token_transition_keys.len() {
-        return Vec::new();
-    }
-
-    accepted_states
+/// Drop every token containing a transition key that no transition of the FSM uses.
+/// Such a token can never be walked from any state, so there is no point in adding it
+/// to the trie. For structured patterns ( digits, dates, IPs, ... ) this removes the
+/// vast majority of the vocabulary.
+fn remove_dead_tokens(
+    live_keys: &FxHashSet<u32>,
+    vocabulary: Vec<(String, Vec<u32>)>,
+    vocabulary_transition_keys: Vec<Vec<u32>>,
+) -> (Vec<(String, Vec<u32>)>, Vec<Vec<u32>>) {
+    vocabulary
+        .into_iter()
+        .zip(vocabulary_transition_keys)
+        .filter(|(_, transition_keys)| transition_keys.iter().all(|key| live_keys.contains(key)))
+        .unzip()
 }
 
+/// Walk the vocabulary trie depth-first from `start_state`, following the FSM transitions.
+/// Every node reached yields its tokens along with the state they end in, and a subtree
+/// is pruned as soon as the FSM has no transition for its prefix, so each shared prefix
+/// is only walked once per state instead of once per token.
 fn state_scan_tokens(
-    fsm_transitions: &FxHashMap<(u32, u32), u32>,
-    fsm_initial: u32,
-    fsm_finals: &Arc<Vec<u32>>,
-    vocabulary: &[(String, Vec<u32>)],
-    vocabulary_transition_keys: &[Vec<u32>],
+    fsm_transitions: &TransitionTable,
+    vocab_trie: &VocabTrie,
     start_state: u32,
-) -> FxHashSet<(u32, u32)> {
-    let mut res = FxHashSet::default();
-
-    for ((_, token_ids), token_transition_keys) in
-        vocabulary.iter().zip(vocabulary_transition_keys.iter())
-    {
-        let state_seq = walk_fsm(
-            fsm_transitions,
-            fsm_initial,
-            fsm_finals,
-            token_transition_keys,
-            start_state,
-            false,
-        );
-
-        if state_seq.len() < token_transition_keys.len() {
-            continue;
-        }
-
-        let last_state = *state_seq.last().unwrap();
-        for &token_id in token_ids {
-            res.insert((token_id, last_state));
+) -> Vec<(u32, u32)> {
+    let mut res = Vec::new();
+    let mut stack = vec![(0u32, start_state)];
+
+    while let Some((node, state)) = stack.pop() {
+        for &(trans_key, child) in &vocab_trie.children[node as usize] {
+            if let Some(next_state) = fsm_transitions.get(state, trans_key) {
+                for &token_id in &vocab_trie.token_ids[child as usize] {
+                    res.push((token_id, next_state));
+                }
+                stack.push((child, next_state));
+            }
         }
     }
 
@@ -133,40 +105,59 @@ fn state_scan_tokens(
 pub fn create_fsm_index_end_to_end_parallel(
     fsm_info: &FSMInfo,
     vocabulary: &TokenVocabulary,
-    return_to: &Arc<Vec<ThreadSafeCell<FxHashMap<u32, u32>>>>,
+    vocab_fingerprint: u64,
+    return_to: &Arc<Vec<ThreadSafeCell<StateTransitions>>>,
     state_notifiers: &StateNotifierMap, 
+    reduce_vocabulary: bool,
 ) {
 
-    let vocabulary_entries: Vec<(String, Vec<u32>)> = vocabulary
-        .iter()
-        .map(|(s, v)| (s.clone(), v.clone()))
-        .collect();
+    let live_keys: Option<FxHashSet<u32>> = reduce_vocabulary
+        .then(|| fsm_info.transitions.keys().map(|&(_, key)| key).collect());
 
-    let vocabulary_transition_keys = get_vocabulary_transition_keys(
+    let trie_key = hash_vocab_trie_key(
+        vocab_fingerprint,
         &fsm_info.alphabet_symbol_mapping,
         fsm_info.alphabet_anything_value,
-        &vocabulary_entries,
+        live_keys.as_ref(),
     );
-    
-    let vocabulary_transition_keys = Arc::new(vocabulary_transition_keys);
-    let fsm_transitions = Arc::new(fsm_info.transitions.clone());
-    let fsm_finals = Arc::new(fsm_info.finals.clone()); 
+
+    // The trie only depends on the vocabulary and the alphabet, so FSMs sharing an
+    // alphabet ( e.g. the same character classes ) reuse the one built first.
+    let vocab_trie = get_or_create_vocab_trie(trie_key, || {
+        let vocabulary_entries: Vec<(String, Vec<u32>)> = vocabulary
+            .iter()
+            .map(|(s, v)| (s.clone(), v.clone()))
+            .collect();
+
+        let vocabulary_transition_keys = get_vocabulary_transition_keys(
+            &fsm_info.alphabet_symbol_mapping,
+            fsm_info.alphabet_anything_value,
+            &vocabulary_entries,
+        );
+
+        let (vocabulary_entries, vocabulary_transition_keys) = match &live_keys {
+            Some(live_keys) => {
+                remove_dead_tokens(live_keys, vocabulary_entries, vocabulary_transition_keys)
+            }
+            None => (vocabulary_entries, vocabulary_transition_keys),
+        };
+
+        VocabTrie::new(&vocabulary_entries, &vocabulary_transition_keys)
+    });
+
+    // Built once and shared by every state's scan.
+    let transition_table = TransitionTable::new(&fsm_info.transitions);
 
     fsm_info.states.par_iter().for_each(|&start_state| {
         let token_ids_end_states = state_scan_tokens(
-            &fsm_transitions,
-            fsm_info.initial,
-            &fsm_finals,
-            &vocabulary_entries,
-            &vocabulary_transition_keys,
+            &transition_table,
+            &vocab_trie,
             start_state,
         );
 
         unsafe {
-            let map = return_to[start_state as usize].get();
-            for (token_id, end_state) in token_ids_end_states {
-                map.insert(token_id, end_state);
-            }
+            *return_to[start_state as usize].get() =
+                StateTransitions::from_pairs(token_ids_end_states);
         }
 
         let notifier = Arc::clone(&state_notifiers[start_state as usize]);
@@ -179,13 +170,60 @@ pub fn create_fsm_index_end_to_end_parallel(
 
 
 /// Create an FSM state-to-vocabulary map/index through end-to-end token parsing. ///
+/// `vocab_hash` identifies the vocabulary in the caches; when the caller already has one
+/// ( e.g. the tokenizer's own hash ) the vocabulary is not fingerprinted again.
 #[pyfunction(name = "create_fsm_index_end_to_end")]
-#[pyo3(text_signature = "(fsm_info, vocabulary, /)")]
+#[pyo3(
+    signature = (fsm_info, vocabulary, eos_token_id, reduce_vocabulary = true, vocab_hash = None),
+    text_signature = "(fsm_info, vocabulary, eos_token_id, reduce_vocabulary=True, vocab_hash=None)"
+)]
 pub fn create_fsm_index_end_to_end_py(
     py: Python<'_>,
     fsm_info: FSMInfo,
     vocabulary: TokenVocabulary,
     eos_token_id: u32,
+    reduce_vocabulary: bool,
+    vocab_hash: Option<u64>,
 ) -> LazyFSMIndex {
-    LazyFSMIndex::new(fsm_info, vocabulary, eos_token_id)
+    // Hashing the vocabulary and spawning the worker does not touch any python objects,
+    // so let other python threads run in the meantime.
+    py.allow_threads(|| {
+        LazyFSMIndex::new(fsm_info, Arc::new(vocabulary), eos_token_id, reduce_vocabulary, vocab_hash)
+    })
+}
+
+/// Create the indexes of several FSMs sharing the same vocabulary in a single call. ///
+/// The vocabulary is only converted from python once, and every index is computed on the
+/// same thread pool, so the states of all the FSMs are interleaved instead of compiling
+/// the patterns one after the other.
+#[pyfunction(name = "create_fsm_indices_batch")]
+#[pyo3(
+    signature = (fsm_infos, vocabulary, eos_token_id, reduce_vocabulary = true, vocab_hash = None),
+    text_signature = "(fsm_infos, vocabulary, eos_token_id, reduce_vocabulary=True, vocab_hash=None)"
+)]
+pub fn create_fsm_indices_batch_py(
+    py: Python<'_>,
+    fsm_infos: Vec<FSMInfo>,
+    vocabulary: TokenVocabulary,
+    eos_token_id: u32,
+    reduce_vocabulary: bool,
+    vocab_hash: Option<u64>,
+) -> Vec<LazyFSMIndex> {
+    py.allow_threads(|| {
+        // Fingerprinted once for the whole batch.
+        let vocab_hash = vocab_hash.unwrap_or_else(|| vocabulary_fingerprint(&vocabulary));
+        let vocabulary = Arc::new(vocabulary);
+        fsm_infos
+            .into_iter()
+            .map(|fsm_info| {
+                LazyFSMIndex::new(
+                    fsm_info,
+                    Arc::clone(&vocabulary),
+                    eos_token_id,
+                    reduce_vocabulary,
+                    Some(vocab_hash),
+                )
+            })
+            .collect()
+    })
 }
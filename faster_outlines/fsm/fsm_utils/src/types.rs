@@ -3,6 +3,7 @@ use rustc_hash::FxHashMap;
 use pyo3::prelude::*;
 
 use std::cell::UnsafeCell;
+use std::sync::Arc;
 
 // Custom wrapper around UnsafeCell
 #[derive(Debug)]
@@ -36,6 +37,179 @@ impl<T> ThreadSafeCell<T> {
 
 pub type TokenVocabulary = FxHashMap<String, Vec<u32>>;
 
+/// The transitions of every state of an index, filled in by the workers as states are
+/// computed. Once computed, the rows are never written again, so the finished table is
+/// shared as is between indexes and the FSM cache.
+pub type StateTransitionsMap = Arc<Vec<ThreadSafeCell<StateTransitions>>>;
+
+/// Number of token ids needed to index every token of the vocabulary, including EOS.
+pub fn vocabulary_size(vocabulary: &TokenVocabulary, eos_token_id: u32) -> usize {
+    vocabulary
+        .values()
+        .flatten()
+        .copied()
+        .chain(std::iter::once(eos_token_id))
+        .max()
+        .map_or(0, |max_id| max_id as usize + 1)
+}
+
+/// Largest dense transition table built, in entries ( 4 bytes each ), i.e. 4 MiB.
+/// Every pattern compiled concurrently holds its own table, so this stays small enough
+/// for a full thread pool of them to fit in memory ( and mostly in cache ).
+const MAX_DENSE_TRANSITIONS: usize = 1 << 20;
+
+/// Marks a missing transition in a dense table.
+const NO_TRANSITION: u32 = u32::MAX;
+
+/// The transitions of an FSM, queried once per trie node and state by the token scan.
+///
+/// State ids and transition keys are small dense integers, so the table is usually a flat
+/// `state * n_keys + key` array: a lookup is an index instead of hashing the pair. FSMs
+/// too large for that keep using the map they came with.
+pub enum TransitionTable<'a> {
+    Dense { n_keys: usize, next_states: Vec<u32> },
+    Sparse(&'a FxHashMap<(u32, u32), u32>),
+}
+
+impl<'a> TransitionTable<'a> {
+    pub fn new(transitions: &'a FxHashMap<(u32, u32), u32>) -> Self {
+        let (max_state, max_key) = transitions.iter().fold(
+            (0u32, 0u32),
+            |(max_state, max_key), (&(from_state, key), &to_state)| {
+                (max_state.max(from_state).max(to_state), max_key.max(key))
+            },
+        );
+        let (n_states, n_keys) = (max_state as usize + 1, max_key as usize + 1);
+
+        if n_states.saturating_mul(n_keys) > MAX_DENSE_TRANSITIONS {
+            return TransitionTable::Sparse(transitions);
+        }
+
+        let mut next_states = vec![NO_TRANSITION; n_states * n_keys];
+        for (&(from_state, key), &to_state) in transitions {
+            next_states[from_state as usize * n_keys + key as usize] = to_state;
+        }
+        TransitionTable::Dense { n_keys, next_states }
+    }
+
+    #[inline(always)]
+    pub fn get(&self, state: u32, key: u32) -> Option<u32> {
+        match self {
+            TransitionTable::Dense { n_keys, next_states } => {
+                if key as usize >= *n_keys {
+                    return None;
+                }
+                match next_states.get(state as usize * n_keys + key as usize) {
+                    Some(&next_state) if next_state != NO_TRANSITION => Some(next_state),
+                    _ => None,
+                }
+            }
+            TransitionTable::Sparse(transitions) => transitions.get(&(state, key)).copied(),
+        }
+    }
+}
+
+/// Rows with at most this many transitions are looked up with a linear scan.
+const SMALL_ROW_LEN: usize = 32;
+
+/// The transitions out of a single FSM state.
+///
+/// Stored as two parallel arrays sorted by token id, rather than a `HashMap`,
+/// so the tokens of a state are one contiguous, ordered slice.
+/// Rows longer than `SMALL_ROW_LEN` also keep the allowed tokens as a bitmap, up to
+/// their largest token id. Together with the running popcount of the bitmap, it turns
+/// a lookup into a constant time rank query. Small rows leave both empty, they are
+/// scanned linearly and would otherwise pay for a bitmap the size of the vocabulary.
+#[derive(Debug, Clone, Default, PartialEq, Eq)]
+pub struct StateTransitions {
+    pub token_ids: Vec<u32>,
+    pub next_states: Vec<u32>,
+    /// Bit `i % 64` of word `i / 64` is set when token `i` is allowed.
+    allowed: Vec<u64>,
+    /// Number of allowed tokens before word `i` of `allowed`.
+    rank: Vec<u32>,
+}
+
+impl StateTransitions {
+    pub fn from_pairs(mut pairs: Vec<(u32, u32)>) -> Self {
+        pairs.sort_unstable_by_key(|&(token_id, _)| token_id);
+        let (token_ids, next_states): (Vec<u32>, Vec<u32>) = pairs.into_iter().unzip();
+        StateTransitions::from_sorted(token_ids, next_states)
+    }
+
+    /// Build a row from parallel arrays whose `token_ids` are already strictly increasing.
+    pub fn from_sorted(token_ids: Vec<u32>, next_states: Vec<u32>) -> Self {
+        if token_ids.len() <= SMALL_ROW_LEN {
+            return StateTransitions { token_ids, next_states, allowed: Vec::new(), rank: Vec::new() };
+        }
+
+        let allowed = bitmap(&token_ids, *token_ids.last().unwrap() as usize + 1);
+        let rank = allowed
+            .iter()
+            .scan(0u32, |count, word| {
+                let before = *count;
+                *count += word.count_ones();
+                Some(before)
+            })
+            .collect();
+
+        StateTransitions { token_ids, next_states, allowed, rank }
+    }
+
+    /// The allowed tokens as a bitmap over a vocabulary of `vocab_size` tokens.
+    pub fn allowed_bitmap(&self, vocab_size: usize) -> Vec<u64> {
+        bitmap(&self.token_ids, vocab_size)
+    }
+
+    /// Small rows are scanned directly, their token ids fit in a couple of cache lines.
+    /// For larger rows, since `token_ids` is sorted, the position of an allowed token is the
+    /// number of allowed tokens below it: the rank of its word plus the set bits under it
+    /// in the word.
+    #[inline(always)]
+    pub fn next_state(&self, token_id: u32) -> Option<u32> {
+        if self.token_ids.len() <= SMALL_ROW_LEN {
+            return self
+                .token_ids
+                .iter()
+                .position(|&id| id == token_id)
+                .map(|idx| self.next_states[idx]);
+        }
+
+        let word_idx = token_id as usize / 64;
+        let word = *self.allowed.get(word_idx)?;
+        let bit = 1u64 << (token_id % 64);
+        if word & bit == 0 {
+            return None;
+        }
+        let idx = self.rank[word_idx] + (word & (bit - 1)).count_ones();
+        Some(self.next_states[idx as usize])
+    }
+
+    #[inline(always)]
+    pub fn len(&self) -> usize {
+        self.token_ids.len()
+    }
+
+    #[inline(always)]
+    pub fn is_empty(&self) -> bool {
+        self.token_ids.is_empty()
+    }
+
+    /// `(token_id, next_state)` pairs, in token id order.
+    pub fn iter(&self) -> impl Iterator<Item = (u32, u32)> + '_ {
+        self.token_ids.iter().copied().zip(self.next_states.iter().copied())
+    }
+}
+
+/// Bitmap of `token_ids` over `n_tokens` tokens, bit `i % 64` of word `i / 64` for token `i`.
+fn bitmap(token_ids: &[u32], n_tokens: usize) -> Vec<u64> {
+    let mut words = vec![0u64; n_tokens.div_ceil(64)];
+    for &token_id in token_ids {
+        words[token_id as usize / 64] |= 1 << (token_id % 64);
+    }
+    words
+}
+
 #[derive(Debug, Clone, Eq, PartialEq, FromPyObject)]
 pub struct FSMInfo {
     /// Initial state of the FSM
@@ -66,93 +240,46 @@ pub struct FSMInfo {
     pub pattern: String,
 }
 
-// `VocabTrie` is a structure designed to efficiently index the vocabulary of a tokenizer. 
-// It facilitates the quick lookup of tokens based on their prefixes and manages relationships between tokens and their substrings, 
-// for operations like token scanning in FSMs.
-
-// - **`parent_children_map`**: Maps a token prefix ID to a vector of child token IDs, enabling quick exploration of possible token continuations.
-// - **`idx_to_token_str`**: Provides an index-based lookup from a token ID to the corresponding token string.
-// - **`token_str_to_idx`**: Maps a token string to its unique ID, facilitating fast conversions from strings to indices.
-// #[derive(Clone)]
-// pub struct VocabTrie {
-//     parent_children_map: Vec<Option<Vec<u32>>>,
-//     idx_to_token_str: Vec<TrieToken>,
-//     root_tokens: Vec<TrieToken>,
-// }
-
-// impl VocabTrie {
-//     #[inline(always)]
-//     pub fn find_children(&self, token_idx: u32) -> Option<Vec<&TrieToken>> {
-//         self.parent_children_map.get(token_idx as usize)
-//             .and_then(|children| children.as_ref())
-//             .map(|children| {
-//                 children.iter()
-//                     .filter_map(|&child_id| self.get_token(child_id))
-//                     .collect()
-//             })
-//     }
-
-//     #[inline(always)]
-//     pub fn get_token(&self, index: u32) -> Option<&TrieToken> {
-//         self.idx_to_token_str.get(index as usize)
-//     }
-
-//     #[inline(always)]
-//     pub fn get_root_tokens(&self) -> &Vec<TrieToken> {
-//         &self.root_tokens
-//     }
-// }
-
-// #[derive(Clone, Debug)]
-// pub struct TrieToken {
-//     pub tok_id: usize,
-//     pub idx: u32,
-//     pub str_len: usize,
-// }
-
-// pub trait VocabTrieBuilder {
-//     fn to_vocab_trie(&self) -> VocabTrie;
-// }
-
-// impl VocabTrieBuilder for TokenVocabulary {
-//     fn to_vocab_trie(&self) -> VocabTrie {
-//         let max_token_id = self.values().flatten().max().map(|&id| id as usize + 1).unwrap_or(0);
-//         let mut parent_children_map = vec![None; max_token_id];
-//         let mut idx_to_token_str = Vec::new();
-//         let mut token_str_to_idx: FxHashMap<String, u32> = FxHashMap::default();
-//         let mut root_tokens = Vec::new();
-
-//         let mut token_id: u32 = 0;
-//         for (token, ids) in self.iter() {
-//             let trie_token = TrieToken {
-//                 tok_id: ids[0] as usize,
-//                 idx: token_id,
-//                 str_len: token.chars().count(),
-//             };
-//             idx_to_token_str.push(trie_token.clone());
-//             token_str_to_idx.insert(token.clone(), token_id);
-
-//             let char_indices: Vec<usize> = token.char_indices().map(|(index, _)| index).collect();
-//             let mut is_root = true;
-//             for i in 0..char_indices.len() - 1 {
-//                 let prefix = &token[..char_indices[i]];
-//                 if self.contains_key(prefix) {
-//                     let prefix_id = *token_str_to_idx.get(prefix).unwrap();
-//                     parent_children_map[prefix_id as usize]
-//                         .get_or_insert_with(Vec::new)
-//                         .push(token_id);
-//                     is_root = false;
-//                 }
-//             }
-//             if is_root {
-//                 root_tokens.push(trie_token);
-//             }
-//             token_id += 1;
-//         }
-//         VocabTrie {
-//             parent_children_map,
-//             idx_to_token_str,
-//             root_tokens,
-//         }
-//     }
-// }
+// `VocabTrie` indexes the vocabulary of a tokenizer by the transition keys of its tokens,
+// so that tokens sharing a prefix also share the FSM walk over that prefix.
+// Since the transition keys depend on the alphabet of the FSM, a trie is built per FSM
+// and then reused for every one of its states.
+
+// - **`children`**: For each node, the `(transition_key, child_node)` edges leaving it.
+// - **`token_ids`**: For each node, the ids of the tokens whose transition keys end at that node.
+#[derive(Clone, Debug)]
+pub struct VocabTrie {
+    pub children: Vec<Vec<(u32, u32)>>,
+    pub token_ids: Vec<Vec<u32>>,
+}
+
+impl VocabTrie {
+    pub fn new(vocabulary: &[(String, Vec<u32>)], vocabulary_transition_keys: &[Vec<u32>]) -> Self {
+        let mut children: Vec<Vec<(u32, u32)>> = vec![Vec::new()];
+        let mut token_ids: Vec<Vec<u32>> = vec![Vec::new()];
+
+        for ((_, ids), transition_keys) in vocabulary.iter().zip(vocabulary_transition_keys.iter()) {
+            let mut node = 0usize;
+            for &trans_key in transition_keys {
+                let existing = children[node]
+                    .iter()
+                    .find(|&&(key, _)| key == trans_key)
+                    .map(|&(_, child)| child as usize);
+
+                node = match existing {
+                    Some(child) => child,
+                    None => {
+                        let child = children.len();
+                        children.push(Vec::new());
+                        token_ids.push(Vec::new());
+                        children[node].push((trans_key, child as u32));
+                        child
+                    }
+                };
+            }
+            token_ids[node].extend_from_slice(ids);
+        }
+
+        VocabTrie { children, token_ids }
+    }
+}
@@ -1,11 +1,97 @@
-from .regex import create_fsm_index_tokenizer
+import math
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+from hashlib import blake2b
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+import torch
+
+from .environment import MASK_CACHE_SIZE, PREFETCH_DEVICE, PREFETCH_STATES
+from .regex import (
+    clear_caches,
+    create_fsm_index_from_fsm,
+    create_fsm_index_tokenizer,
+    make_deterministic_fsm,
+)
+from .utils import LRUCache
 import interegular
 
+_prepare_executor = None
+_prepare_executor_lock = threading.Lock()
+
+
+def _get_prepare_executor() -> ThreadPoolExecutor:
+    global _prepare_executor
+    with _prepare_executor_lock:
+        if _prepare_executor is None:
+            _prepare_executor = ThreadPoolExecutor(
+                max_workers=os.cpu_count(), thread_name_prefix="faster_outlines_prepare"
+            )
+        return _prepare_executor
+
+
+def _resolve_device(device) -> torch.device:
+    """`device` as a `torch.device`, with the current index filled in for bare `"cuda"`,
+    so it compares equal to the `device` of tensors living there."""
+    device = torch.device(device)
+    if device.type == "cuda" and device.index is None:
+        device = torch.device("cuda", torch.cuda.current_device())
+    return device
+
+
+def _default_prefetch_device() -> torch.device:
+    if PREFETCH_DEVICE is not None:
+        return _resolve_device(PREFETCH_DEVICE)
+    return _resolve_device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+class _MaskBank:
+    """The logits masks of the states a guide has masked batches for, stacked into one
+    `[n_states, vocab]` tensor, plus the `[batch, vocab]` buffer they are gathered into.
+
+    One bank per vocabulary size, device and dtype. Rows are only appended, the first
+    time a state shows up in a batch."""
+
+    __slots__ = ("rows", "masks", "buffer")
+
+    def __init__(self):
+        self.rows: Dict[int, int] = {}
+        self.masks = None
+        self.buffer = None
+
+
 class RegexGuide():
     """Guide to generate text in the language of a regular expression."""
 
+    # The attributes read on every decode step are slots, looked up through their
+    # descriptor rather than the instance dict. `__dict__` is kept for the cached
+    # properties and the pending index of `prepare`.
+    __slots__ = (
+        "fsm",
+        "empty_token_ids",
+        "eos_token_id",
+        "final_states",
+        "states_to_token_masks",
+        "states_to_logits_masks",
+        "_forced_prefix",
+        "_state_to_subset",
+        "_mask_banks",
+        "__dict__",
+    )
+
     initial_state = 0
 
+    # Many states, across guides as well, allow exactly the same tokens. Their
+    # token tensors are pooled here, keyed by a digest of the allowed token ids
+    # and the device they live on. Bounded by `FASTER_OUTLINES_MASK_CACHE_SIZE`.
+    _mask_cache: LRUCache = LRUCache(MASK_CACHE_SIZE)
+    # Same for the additive logits masks, keyed by the digest, vocabulary size, device and dtype.
+    _logits_mask_cache: LRUCache = LRUCache(MASK_CACHE_SIZE)
+
     def __init__(self, regex_string: str, tokenizer: "Tokenizer"):
         (
             self.fsm,
@@ -14,10 +100,72 @@ class RegexGuide():
         ) = create_fsm_index_tokenizer(regex_string, tokenizer)
         self.eos_token_id = tokenizer.eos_token_id
         self.final_states = fsm_finals | {-1}
+        self._init_caches()
+
+    def _init_caches(self):
+        # Per guide caches, filled lazily as states are visited.
+        self.states_to_token_masks = {}
+        self.states_to_logits_masks = {}
+        self._forced_prefix = {}
+        self._state_to_subset = {}
+        self._mask_banks = {}
+        if PREFETCH_STATES > 0:
+            self.prefetch(PREFETCH_STATES)
+
+    @classmethod
+    def prepare(cls, regex_string: str, tokenizer: "Tokenizer") -> "RegexGuide":
+        """Start building the guide of `regex_string` in the background and return at once.
+
+        The pattern is compiled on a shared thread pool, so a caller can prepare the guide
+        when a request comes in and let the model run its prefill in the meantime. The
+        guide only blocks on the first access to its index ( e.g. in `get_next_state` ).
+        """
+        guide = cls.__new__(cls)
+        guide._pending = _get_prepare_executor().submit(
+            create_fsm_index_tokenizer, regex_string, tokenizer
+        )
+        guide.eos_token_id = tokenizer.eos_token_id
+        guide._init_caches()
+        return guide
+
+    def __getattr__(self, name):
+        # Only called for missing attributes, i.e. the index of a guide from `prepare`
+        # that has not been resolved yet.
+        pending = self.__dict__.get("_pending")
+        if pending is None or name not in ("fsm", "empty_token_ids", "final_states"):
+            raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+
+        self.fsm, self.empty_token_ids, fsm_finals = pending.result()
+        self.final_states = fsm_finals | {-1}
+        self.__dict__.pop("_pending", None)
+        return getattr(self, name)
         
-    @property
-    def states_to_token_maps(self):
-        self.fsm.get_states_to_token_subsets()
+    @cached_property
+    def states_to_token_maps(self) -> Dict[int, Dict[int, int]]:
+        """The whole `{state: {token_id: next_state}}` index, as plain dicts.
+
+        This waits for every state to be computed, and is only built on first access.
+        The guide itself never uses it, it is kept for code expecting outlines' attribute.
+        """
+        return self.fsm.get_states_to_token_subsets()
+
+    @cached_property
+    def transition_arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """The whole index as flat arrays: `(offsets, token_ids, next_states)`.
+
+        The transitions of state `s` are `token_ids[offsets[s]:offsets[s + 1]]`, sorted,
+        leading to the matching `next_states`. `offsets` is int64, the two others int32.
+        A compact alternative to `states_to_token_maps` for vectorized code, e.g. looking
+        up a transition with `np.searchsorted`. Waits for every state to be computed.
+        """
+        row_offsets, token_ids, next_states = (
+            np.frombuffer(buffer, dtype="<u4") for buffer in self.fsm.transitions_csr()
+        )
+        return (
+            row_offsets.astype(np.int64),
+            token_ids.astype(np.int32),
+            next_states.astype(np.int32),
+        )
 
     def get_next_instruction(self, state: int):
         """Return the next instruction for guided generation.
@@ -44,6 +192,78 @@ class RegexGuide():
         """
         return self.fsm.get_next_instruction(state)
 
+    def get_allowed_tokens_tensor(self, state: int, device="cpu") -> torch.Tensor:
+        """Return the ids of the tokens allowed in `state`, as an int tensor on `device`.
+
+        The tensor is built and copied to `device` once per state, and shared with every
+        other state allowing the same tokens. It must not be modified in place.
+        """
+        device = _resolve_device(device)
+        allowed_tokens = self.states_to_token_masks.get((state, device))
+        if allowed_tokens is None:
+            # Viewing the buffer filled by rust skips building a python list of the ids.
+            token_ids = np.frombuffer(self.fsm.allowed_token_ids_buffer(state), dtype="<i4")
+            subset = blake2b(token_ids.tobytes(), digest_size=16).digest()
+            self._state_to_subset[state] = subset
+            key = (subset, device)
+            allowed_tokens = self._mask_cache.get(key)
+            if allowed_tokens is None:
+                allowed_tokens = torch.from_numpy(token_ids).to(device)
+                self._mask_cache[key] = allowed_tokens
+            self.states_to_token_masks[(state, device)] = allowed_tokens
+        return allowed_tokens
+
+    def get_forced_prefix(self, state: int) -> List[int]:
+        """Return the tokens the guide forces from `state`, before it allows a choice.
+
+        Follows the states which only allow a single token, until one allows several, a
+        final state is reached or the chain would loop. The caller can append the whole
+        prefix in a single forward pass instead of one decode step per token, then advance
+        the state with `get_next_state` for each of them. Empty when `state` allows more
+        than one token. Cached per state.
+        """
+        prefix = self._forced_prefix.get(state)
+        if prefix is None:
+            prefix = self.fsm.get_forced_tokens(state)
+            self._forced_prefix[state] = prefix
+        return prefix
+
+    def prefetch(self, max_states: int, device=None) -> threading.Thread:
+        """Compute the allowed tokens tensors of up to `max_states` states in the background.
+
+        States are visited breadth first from the initial state, i.e. in the order generation
+        is most likely to reach them, so the tensors are usually cached before the decode loop
+        asks for them. Meant to run while the model does its prefill. Returns the started
+        daemon thread.
+
+        The tensors are put on `device`, which should be the device of the logits the guide
+        masks. It defaults to `FASTER_OUTLINES_PREFETCH_DEVICE`, or the current CUDA device
+        when there is one, the CPU otherwise.
+        """
+        if device is None:
+            device = _default_prefetch_device()
+        thread = threading.Thread(
+            target=self._prefetch_states,
+            args=(max_states, device),
+            name="faster_outlines_prefetch",
+            daemon=True,
+        )
+        thread.start()
+        return thread
+
+    def _prefetch_states(self, max_states: int, device):
+        queue = deque([self.initial_state])
+        seen = {self.initial_state}
+        while queue and max_states > 0:
+            state = queue.popleft()
+            # Rust waits for the state with the GIL released, the decode thread keeps running.
+            self.get_allowed_tokens_tensor(state, device)
+            max_states -= 1
+            for next_state in self.fsm.next_states(state):
+                if next_state not in seen:
+                    seen.add(next_state)
+                    queue.append(next_state)
+
     def get_next_state(self, state: int, token_id: int) -> int:
         """Update the state of the guide.
 
@@ -64,21 +284,111 @@ class RegexGuide():
         """
         return self.fsm.get_next_state(state, token_id)
 
+    def get_logits_mask(
+        self, state: int, vocab_size: int, device="cpu", dtype: torch.dtype = torch.float32
+    ) -> torch.Tensor:
+        """Return the additive logits mask of `state`: 0 for allowed tokens, -inf elsewhere.
+
+        The mask is built once per set of allowed tokens, vocabulary size, device and dtype,
+        and shared by every state ( of any guide ) allowing the same tokens. Applying it is a
+        single addition instead of filling ( and copying ) a fresh vocabulary sized tensor
+        at every step.
+        """
+        device = _resolve_device(device)
+        key = (state, vocab_size, device, dtype)
+        mask = self.states_to_logits_masks.get(key)
+        if mask is None:
+            allowed_tokens = self.get_allowed_tokens_tensor(state, device)
+            pool_key = (self._state_to_subset[state], vocab_size, device, dtype)
+            mask = self._logits_mask_cache.get(pool_key)
+            if mask is None:
+                mask = torch.full((vocab_size,), -math.inf, device=device, dtype=dtype)
+                mask[allowed_tokens] = 0
+                self._logits_mask_cache[pool_key] = mask
+            self.states_to_logits_masks[key] = mask
+        return mask
+
+    def mask_logits(self, state: int, logits: torch.Tensor) -> torch.Tensor:
+        """Return `logits` with every token not allowed in `state` set to -inf.
+
+        The mask has the dtype of `logits`, so half precision logits stay half precision.
+        """
+        return logits + self.get_logits_mask(state, logits.shape[-1], logits.device, logits.dtype)
+
+    def mask_logits_(self, state: int, logits: torch.Tensor) -> torch.Tensor:
+        """In place version of `mask_logits`.
+
+        Keeps the allowed logits aside, fills `logits` with -inf and writes them back,
+        so neither a vocabulary sized mask nor a cache of them is needed.
+        """
+        allowed_tokens = self.get_allowed_tokens_tensor(state, logits.device)
+        allowed_logits = logits[..., allowed_tokens]
+        logits.fill_(-math.inf)
+        logits[..., allowed_tokens] = allowed_logits
+        return logits
+
+    def mask_logits_batch(self, states: Sequence[int], logits: torch.Tensor) -> torch.Tensor:
+        """Batched `mask_logits_`: row `i` of `logits` ( `[batch, vocab]` ) is masked in place
+        for `states[i]`, and `logits` is returned.
+
+        The masks of the rows are gathered from the bank of this guide into a reusable
+        `[batch, vocab]` buffer with a single `index_select`, and added to `logits` at once.
+        """
+        if logits.dim() != 2 or len(states) != logits.shape[0]:
+            raise ValueError(
+                f"Expected one state per row of the logits, got {len(states)} states "
+                f"for logits of shape {tuple(logits.shape)}"
+            )
+        vocab_size, device, dtype = logits.shape[-1], _resolve_device(logits.device), logits.dtype
+        bank = self._mask_banks.get((vocab_size, device, dtype))
+        if bank is None:
+            bank = self._mask_banks[(vocab_size, device, dtype)] = _MaskBank()
+
+        rows, new_masks = [], []
+        for state in states:
+            row = bank.rows.get(state)
+            if row is None:
+                row = bank.rows[state] = len(bank.rows)
+                new_masks.append(self.get_logits_mask(state, vocab_size, device, dtype))
+            rows.append(row)
+        if new_masks:
+            new_masks = torch.stack(new_masks)
+            bank.masks = new_masks if bank.masks is None else torch.cat((bank.masks, new_masks))
+
+        if bank.buffer is None or bank.buffer.shape[0] != len(states):
+            bank.buffer = torch.empty((len(states), vocab_size), device=device, dtype=dtype)
+        rows = torch.tensor(rows, dtype=torch.long, device=device)
+        torch.index_select(bank.masks, 0, rows, out=bank.buffer)
+        return logits.add_(bank.buffer)
+
+    @classmethod
+    def clear_cache(cls):
+        """Drop every FSM and index cached in memory, python and rust side.
+
+        Guides built from the same pattern and tokenizer share their index, so this
+        is mostly useful for tests and benchmarks that need to build them from scratch.
+        """
+        clear_caches()
+        cls._mask_cache.clear()
+        cls._logits_mask_cache.clear()
+
     @classmethod
     def from_interegular_fsm(
         cls, interegular_fsm: interegular.fsm.FSM, tokenizer: "Tokenizer"
     ):
         from_interegular_instance = cls.__new__(cls)
 
-        byte_fsm = make_byte_level_fsm(interegular_fsm.reduce(), keep_utf8=True)
-        regex_fsm, _ = make_deterministic_fsm(byte_fsm)
+        # The vocabulary is matched character by character, like the FSMs of patterns,
+        # so the FSM only needs its deterministic labelling.
+        regex_fsm, _ = make_deterministic_fsm(interegular_fsm.reduce())
 
         (
             from_interegular_instance.fsm,
             from_interegular_instance.empty_token_ids,
             fsm_finals,
-        ) = create_fsm_index_tokenizer(regex_fsm, tokenizer)
+        ) = create_fsm_index_from_fsm(regex_fsm, tokenizer)
 
         from_interegular_instance.eos_token_id = tokenizer.eos_token_id
         from_interegular_instance.final_states = fsm_finals | {-1}
+        from_interegular_instance._init_caches()
         return from_interegular_instance
@@ -2,11 +2,14 @@
 # Official outlines repo, so cred to them.
 # It's just included here because it makes patching easier.
 
+from functools import lru_cache
+from hashlib import blake2b
 from typing import (
     TYPE_CHECKING,
     Dict,
+    FrozenSet,
     List,
-    Set, 
+    Optional,
     Tuple, 
     NewType
 )
@@ -19,8 +22,10 @@ from interegular.fsm import (
 )
 from interegular import parse_pattern
 
-from .fsm_utils import create_fsm_index_end_to_end
-from .utils import reduced_vocabulary
+from .fsm_utils import clear_fsm_cache, create_fsm_index_end_to_end, create_fsm_indices_batch, LazyFSMIndex
+from .utils import LRUCache, reduced_vocabulary
+from . import _disk_cache
+from .environment import DISABLE_CACHE, FSM_CACHE_SIZE
 
 if TYPE_CHECKING:
     from .tokenizer_fsm_patch import Tokenizer
@@ -138,6 +143,15 @@ def create_fsm_info(
     anything_value = py_anything_value
     states = list(states)
     states.sort()
+
+    # Deterministic id of the FSM, used as the `pattern` ( cache key of the rust side )
+    # when the FSM does not come from a pattern string. The sorted record arrays are
+    # hashed as raw bytes, without going through python tuples.
+    fsm_id = blake2b(digest_size=16)
+    fsm_id.update(np.array([initial, anything_value, *sorted(finals)], dtype=np.int64).tobytes())
+    fsm_id.update(np.sort(flat_transition_map_items).tobytes())
+    fsm_id.update(np.sort(alphabet_symbol_mapping_items).tobytes())
+
     return {
         "initial": initial,
         "finals": finals,
@@ -146,6 +160,7 @@ def create_fsm_info(
         "trans_key_to_states": trans_key_to_states,
         "alphabet_anything_value": anything_value,
         "alphabet_symbol_mapping": alphabet_symbol_map,
+        "pattern": f"fsm-{fsm_id.hexdigest()}",
     }
 
 
@@ -222,25 +237,245 @@ def make_deterministic_fsm(fsm: FSM) -> Tuple[BetterFSM, Dict[int, int]]:
 
     return new_fsm, old_to_new_states
 
+_REGEX_METACHARACTERS = frozenset("\\^$.?*+()[]{}")
+
+
+def literal_alternation_to_fsm(regex_str: str) -> Optional[FSM]:
+    """Build the minimal FSM of a pattern made only of literal alternatives.
+
+    Enum like patterns ( `yes|no|maybe` ) and fixed strings are the most common guides,
+    and their automaton is simply the trie of the alternatives with identical suffixes
+    merged, built here in linear time. An empty alternative makes the initial state
+    final. Returns `None` for any other pattern, which has to go through interegular.
+    """
+    if not _REGEX_METACHARACTERS.isdisjoint(regex_str):
+        return None
+    alternatives = regex_str.split("|")
+
+    # `None` marks the end of an alternative.
+    trie: Dict = {}
+    for alternative in alternatives:
+        node = trie
+        for char in alternative:
+            node = node.setdefault(char, {})
+        node[None] = {}
+
+    # Identical subtries are interned into one state, bottom up, which leaves the
+    # minimal automaton of the ( finite ) language.
+    chars = sorted({char for alternative in alternatives for char in alternative})
+    symbol_mapping = {anything_else: 0, **{char: i + 1 for i, char in enumerate(chars)}}
+    states: Dict[Tuple, int] = {}
+    transitions: Dict[int, Dict[int, int]] = {}
+    finals = set()
+
+    # Iterative post order walk, long literals would overflow the recursion limit.
+    node_states: Dict[int, int] = {}
+    stack = [(trie, False)]
+    while stack:
+        node, children_done = stack.pop()
+        if not children_done:
+            stack.append((node, True))
+            stack.extend((child, False) for char, child in node.items() if char is not None)
+            continue
+        trans_map = {
+            symbol_mapping[char]: node_states[id(child)]
+            for char, child in node.items()
+            if char is not None
+        }
+        signature = (None in node, tuple(sorted(trans_map.items())))
+        state = states.get(signature)
+        if state is None:
+            state = states[signature] = len(states)
+            transitions[state] = trans_map
+            if None in node:
+                finals.add(state)
+        node_states[id(node)] = state
+
+    initial = node_states[id(trie)]
+    return FSM(
+        alphabet=Alphabet(symbol_mapping),
+        states=set(transitions),
+        initial=initial,
+        finals=finals,
+        map=transitions,
+        __no_validation__=True,
+    )
+
+
+def regex_to_fsm(regex_str: str) -> BetterFSM:
+    """Parse and minimize `regex_str` into a deterministically labelled `BetterFSM`."""
+    fsm = literal_alternation_to_fsm(regex_str)
+    if fsm is None:
+        fsm = parse_pattern(regex_str).to_fsm().reduce()
+    fsm, _ = make_deterministic_fsm(fsm)
+    return fsm
+
+
+def _vocabulary_hash(tokenizer: "Tokenizer") -> Optional[int]:
+    # Only tokenizers hashing their vocabulary can stand in for rust's own fingerprint,
+    # other hashes may be identity based and reused by a different tokenizer.
+    return getattr(tokenizer, "vocabulary_hash", None)
+
+
+def _index_result(
+    lazy_fsm_index: LazyFSMIndex, empty_token_ids: FrozenSet[int], finals
+) -> Tuple[LazyFSMIndex, FrozenSet[int], FrozenSet[int]]:
+    # Results are cached and shared by every caller, so nothing returned is mutable.
+    return lazy_fsm_index, empty_token_ids, frozenset(finals)
+
+
+def create_fsm_index_from_fsm(
+    fsm: BetterFSM,
+    tokenizer: "Tokenizer",
+    reduce_vocabulary: bool = True,
+) -> Tuple[LazyFSMIndex, FrozenSet[int], FrozenSet[int]]:
+    """Construct the FSM index of an already built `fsm`, e.g. one not coming from a pattern.
+
+    The memoized `fsm.fsm_info` is handed to rust as is, its `pattern` is the structural
+    id of the FSM unless the caller set the pattern string it was built from.
+    """
+    vocabulary, empty_token_ids = reduced_vocabulary(tokenizer)
+    fsm_info = fsm.fsm_info
+    # rust impl expects generic types, so just cast them.
+    lazy_fsm_index = create_fsm_index_end_to_end(fsm_info, dict(vocabulary), tokenizer.eos_token_id, reduce_vocabulary, _vocabulary_hash(tokenizer))  # type: ignore
+    return _index_result(lazy_fsm_index, empty_token_ids, fsm_info['finals'])
+
+
+# Indexes built from patterns, keyed on the pattern, the tokenizer and `reduce_vocabulary`.
+# A `LazyFSMIndex` is never mutated once created, so the same index can safely be handed
+# out for every guide built from the same pattern and tokenizer. This also skips the
+# python side of the work ( regex parsing and FSM reduction ), which the rust cache cannot.
+_index_cache = LRUCache(0 if DISABLE_CACHE else FSM_CACHE_SIZE)
+
+
+def _disk_cache_key(regex_str: str, tokenizer: "Tokenizer", reduce_vocabulary: bool) -> Optional[str]:
+    vocabulary_hash = _vocabulary_hash(tokenizer)
+    # Read through the module at call time, so the directory can be changed after import.
+    if _disk_cache.DISK_CACHE_DIR is None or vocabulary_hash is None:
+        return None
+    return _disk_cache.cache_key(regex_str, vocabulary_hash, reduce_vocabulary)
+
+
+def _cached_index(regex_str: str, tokenizer: "Tokenizer", reduce_vocabulary: bool):
+    """The index of `regex_str` from the memory cache, else the disk cache, else `None`."""
+    result = _index_cache.get((regex_str, tokenizer, reduce_vocabulary))
+    if result is not None:
+        return result
+
+    disk_cache_key = _disk_cache_key(regex_str, tokenizer, reduce_vocabulary)
+    if disk_cache_key is None:
+        return None
+    vocab_size = max(max(tokenizer.vocabulary.values()), tokenizer.eos_token_id) + 1
+    lazy_fsm_index = _disk_cache.load(disk_cache_key, vocab_size)
+    if lazy_fsm_index is None:
+        return None
+    _, empty_token_ids = reduced_vocabulary(tokenizer)
+    result = _index_result(lazy_fsm_index, empty_token_ids, lazy_fsm_index.finals)
+    _index_cache[(regex_str, tokenizer, reduce_vocabulary)] = result
+    return result
+
+
+def _build_indices(regex_strs: List[str], tokenizer: "Tokenizer", reduce_vocabulary: bool):
+    """Compute the indexes of `regex_strs` with a single call into rust, and cache them."""
+    vocabulary, empty_token_ids = reduced_vocabulary(tokenizer)
+
+    fsm_infos = []
+    for regex_str in regex_strs:
+        fsm_info = regex_to_fsm(regex_str).fsm_info
+        fsm_info['pattern'] = regex_str
+        fsm_infos.append(fsm_info)
+
+    # The vocabulary is handed to rust once, and the indexes are all computed
+    # concurrently on the same thread pool.
+    lazy_fsm_indices = create_fsm_indices_batch(fsm_infos, dict(vocabulary), tokenizer.eos_token_id, reduce_vocabulary, _vocabulary_hash(tokenizer))  # type: ignore
+
+    results = []
+    for regex_str, fsm_info, lazy_fsm_index in zip(regex_strs, fsm_infos, lazy_fsm_indices):
+        result = _index_result(lazy_fsm_index, empty_token_ids, fsm_info['finals'])
+        _index_cache[(regex_str, tokenizer, reduce_vocabulary)] = result
+        disk_cache_key = _disk_cache_key(regex_str, tokenizer, reduce_vocabulary)
+        if disk_cache_key is not None:
+            _disk_cache.store(disk_cache_key, lazy_fsm_index)
+        results.append(result)
+    return results
+
+
 def create_fsm_index_tokenizer(
     regex_str: str,
     tokenizer: "Tokenizer",
-) -> Tuple[Dict[int, Dict[int, int]], Set[int]]:
+    reduce_vocabulary: bool = True,
+) -> Tuple[LazyFSMIndex, FrozenSet[int], FrozenSet[int]]:
     """Construct an FSM index from a tokenizer.
 
     This uses the end-to-end approach of `create_fsm_index_end_to_end`.
+    When `reduce_vocabulary` is set, tokens containing characters that no
+    transition of the FSM accepts are dropped before the states are scanned.
+
+    When `FASTER_OUTLINES_DISK_CACHE_DIR` is set, indexes are loaded from and saved to
+    that directory, keyed on the pattern and the tokenizer's vocabulary hash ( tokenizers
+    without one are not disk cached ). Saving happens on a background thread once the
+    index is fully computed.
 
     .. warning::
 
         `fsm` needs to be deterministically ordered so that future caching makes sense.
 
     """
-    fsm, _ = make_deterministic_fsm(parse_pattern(regex_str).to_fsm().reduce())
-    vocabulary, empty_token_ids = reduced_vocabulary(tokenizer)
+    result = _cached_index(regex_str, tokenizer, reduce_vocabulary)
+    if result is None:
+        (result,) = _build_indices([regex_str], tokenizer, reduce_vocabulary)
+    return result
 
-    fsm_info = fsm.fsm_info
-    finals = set(fsm_info['finals'])
-    fsm_info['pattern'] = regex_str
-    # rust impl expects generic types, so just cast them.
-    lazy_fsm_index = create_fsm_index_end_to_end(fsm_info, dict(vocabulary), tokenizer.eos_token_id)  # type: ignore
-    return lazy_fsm_index, empty_token_ids, finals
+
+def create_fsm_indices_tokenizer(
+    regex_strs: List[str],
+    tokenizer: "Tokenizer",
+    reduce_vocabulary: bool = True,
+) -> List[Tuple[LazyFSMIndex, FrozenSet[int], FrozenSet[int]]]:
+    """Construct the FSM indexes of several patterns for the same tokenizer at once.
+
+    Equivalent to calling `create_fsm_index_tokenizer` on each pattern, and backed by
+    the same caches, but the patterns missing from them are computed with a single call
+    into rust.
+    """
+    results = {
+        regex_str: _cached_index(regex_str, tokenizer, reduce_vocabulary)
+        for regex_str in dict.fromkeys(regex_strs)
+    }
+    misses = [regex_str for regex_str, result in results.items() if result is None]
+    if misses:
+        results.update(zip(misses, _build_indices(misses, tokenizer, reduce_vocabulary)))
+    return [results[regex_str] for regex_str in regex_strs]
+
+
+def warmup(tokenizer: "Tokenizer"):
+    """Pay the one-time costs of the first guide up front, e.g. while the model loads.
+
+    This builds the reduced vocabulary of `tokenizer` ( cached from then on ), and
+    compiles a trivial pattern, which starts the rust thread pool.
+    """
+    lazy_fsm_index, _, _ = create_fsm_index_tokenizer("a", tokenizer)
+    lazy_fsm_index.await_finished()
+
+
+# The FSM only depends on the pattern, so it is cached on its own: building the same
+# pattern for a different tokenizer skips interegular's reduce() entirely.
+if not DISABLE_CACHE:
+    regex_to_fsm = lru_cache(maxsize=FSM_CACHE_SIZE)(regex_to_fsm)
+
+
+def clear_caches(keep_vocabulary: bool = False):
+    """Drop every FSM and index cached in memory, python and rust side.
+
+    With `keep_vocabulary`, the reduced vocabulary of each tokenizer is kept, e.g. to
+    time compiles from scratch without paying for it again every time.
+    """
+    _index_cache.clear()
+    cached_functions = [regex_to_fsm]
+    if not keep_vocabulary:
+        cached_functions.append(reduced_vocabulary)
+    for cached in cached_functions:
+        # The python caches are not installed when FASTER_OUTLINES_DISABLE_CACHE is set.
+        if hasattr(cached, "cache_clear"):
+            cached.cache_clear()
+    clear_fsm_cache()
@@ -1,4 +1,6 @@
 import torch
+import pickle
+from hashlib import blake2b
 from abc import abstractmethod
 from typing import TYPE_CHECKING, Dict, Hashable, List, Protocol, Set, Tuple, Union
 
@@ -45,6 +47,30 @@ class Tokenizer(Protocol, Hashable):
 SPIECE_UNDERLINE = "\u2581"
 
 
+def _byte_level_decoder() -> Dict[str, int]:
+    """Inverse of the byte to unicode table used by byte-level BPE tokenizers ( GPT-2 and co )."""
+    byte_values = (
+        list(range(ord("!"), ord("~") + 1))
+        + list(range(ord("¡"), ord("¬") + 1))
+        + list(range(ord("®"), ord("ÿ") + 1))
+    )
+    chars = byte_values[:]
+    n = 0
+    for b in range(256):
+        if b not in byte_values:
+            byte_values.append(b)
+            chars.append(256 + n)
+            n += 1
+    return {chr(c): b for b, c in zip(byte_values, chars)}
+
+
+def _is_byte_level(tokenizer: "PreTrainedTokenizer") -> bool:
+    if not getattr(tokenizer, "is_fast", False):
+        return False
+    decoder = tokenizer.backend_tokenizer.decoder
+    return decoder is not None and type(decoder).__name__ == "ByteLevel"
+
+
 class TransformerTokenizer(Tokenizer):
     """Represents a tokenizer for models in the `transformers` library."""
 
@@ -65,6 +91,10 @@ class TransformerTokenizer(Tokenizer):
 
         self.vocabulary = self.tokenizer.get_vocab()
 
+        # Byte-level tokens can be decoded in python directly, which is much cheaper
+        # than going through `convert_tokens_to_string` once per token of the vocabulary.
+        self.byte_decoder = _byte_level_decoder() if _is_byte_level(tokenizer) else None
+
     def encode(
         self, prompt: Union[str, List[str]], **kwargs
     ) -> Tuple[torch.LongTensor, torch.LongTensor]:
@@ -78,6 +108,15 @@ class TransformerTokenizer(Tokenizer):
         return text
 
     def convert_token_to_string(self, token: str) -> str:
+        if self.byte_decoder is not None:
+            try:
+                return bytes(self.byte_decoder[char] for char in token).decode(
+                    "utf-8", errors="replace"
+                )
+            except KeyError:
+                # Added tokens are not byte-level encoded.
+                pass
+
         string = self.tokenizer.convert_tokens_to_string([token])
 
         # A hack to handle missing spaces to HF's Llama tokenizers
@@ -97,10 +136,24 @@ class TransformerTokenizer(Tokenizer):
         return NotImplemented
 
     def __hash__(self):
-        from datasets.fingerprint import Hasher
-        if self.hash is not None:
-            return self.hash
-        
-        else:
-            self.hash =  hash(Hasher.hash(self.tokenizer))
-            return self.hash
+        if self.hash is None:
+            # Only the vocabulary, eos token and special tokens ( dropped from the reduced
+            # vocabulary ) affect the compiled FSMs, so fingerprint those instead of
+            # pickling the whole tokenizer object.
+            payload = pickle.dumps(
+                (
+                    sorted(self.vocabulary.items()),
+                    self.eos_token_id,
+                    sorted(self.special_tokens),
+                ),
+                protocol=5,
+            )
+            self.hash = int.from_bytes(
+                blake2b(payload, digest_size=8).digest(), "little", signed=True
+            )
+        return self.hash
+
+    @property
+    def vocabulary_hash(self) -> int:
+        """The vocabulary fingerprint of `__hash__`, as the unsigned 64 bit int rust expects."""
+        return hash(self) & 0xFFFF_FFFF_FFFF_FFFF
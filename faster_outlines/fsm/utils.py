@@ -1,21 +1,62 @@
+import threading
+from collections import OrderedDict
 from functools import lru_cache
 
 
+class LRUCache:
+    """Thread safe mapping holding at most `maxsize` entries, least recently used ones
+    are evicted first. Unlike `lru_cache`, entries can be looked up without computing them."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._entries.get(key, default)
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
 @lru_cache
 def reduced_vocabulary(tokenizer):
     """Create a map from decoded vocabulary tokens to lists of equivalent token ids."""
     vocabulary = {}
     empty_token_ids = set()
+
+    # Bound once, this loop runs over the whole vocabulary.
+    special_tokens = tokenizer.special_tokens
+    convert_token_to_string = tokenizer.convert_token_to_string
+    add_token = vocabulary.setdefault
+    add_empty_token = empty_token_ids.add
+
     for token, token_idx in tokenizer.vocabulary.items():
-        if token in tokenizer.special_tokens:
+        if token in special_tokens:
             continue
 
-        token_str = tokenizer.convert_token_to_string(token)
+        token_str = convert_token_to_string(token)
 
         if token_str:
             # Ensure the key exists with an empty list, then append
-            vocabulary.setdefault(token_str, []).append(token_idx)
+            add_token(token_str, []).append(token_idx)
         else:
-            empty_token_ids.add(token_idx)
+            add_empty_token(token_idx)
 
-    return vocabulary, empty_token_ids
+    # Frozen, the cached result is handed to every caller.
+    return vocabulary, frozenset(empty_token_ids)
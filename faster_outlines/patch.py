@@ -1,10 +1,6 @@
 import sys
-from .fsm import (
-    RegexGuide,
-    Write,
-    Generate
-)
-    
+
+
 def patch(outlines_module, save_to_sys_modules=True):
     """
     Patch the vanilla `outlines` module to use the `faster-outlines` backend.
@@ -40,6 +36,9 @@ def patch(outlines_module, save_to_sys_modules=True):
     >>> patched_outlines = patch(outlines)
     >>> # Now, all uses of the module will use the backend from `faster_outlines`.
     """
+    # Imported here so `import faster_outlines` stays cheap until something gets patched.
+    from .fsm import RegexGuide, Write, Generate
+
     try:
         # Check if 'outlines' is in sys.modules
         if 'outlines' not in sys.modules:
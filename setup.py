@@ -6,6 +6,12 @@ from setuptools_rust import Binding, RustExtension
 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# Build for the CPU of this machine ( AVX2, BMI2, ... ). The binary is then not portable,
+# so this is opt in, for local installs only. Set through RUSTFLAGS so that every crate
+# ( rayon, hashbrown, ... ) is compiled for it, not only ours.
+if os.environ.get("FASTER_OUTLINES_NATIVE", "").lower() in ("1", "true", "yes"):
+    os.environ["RUSTFLAGS"] = f"{os.environ.get('RUSTFLAGS', '')} -C target-cpu=native".strip()
+
 
 def read_dependencies():
     pyproject_path = os.path.join(CURRENT_DIR, 'pyproject.toml')
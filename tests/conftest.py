@@ -0,0 +1,23 @@
+import pytest
+
+
+class MockVocabularyTokenizer:
+    """Tokenizer whose tokens are their own strings, with ids in the order given."""
+
+    special_tokens = {"eos"}
+
+    def __init__(self, tokens, vocabulary_hash=None):
+        self.vocabulary = {token: token_id for token_id, token in enumerate(tokens)}
+        self.eos_token_id = self.vocabulary["eos"]
+        if vocabulary_hash is not None:
+            # Only tokenizers with a vocabulary hash are disk cached.
+            self.vocabulary_hash = vocabulary_hash
+
+    def convert_token_to_string(self, token):
+        return token
+
+
+@pytest.fixture
+def mock_tokenizer():
+    """Factory of `MockVocabularyTokenizer`s: `mock_tokenizer(tokens)`, `tokens` including "eos"."""
+    return MockVocabularyTokenizer
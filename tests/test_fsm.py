@@ -94,3 +94,296 @@ def test_regex_final_state():
 
     state = fsm.next_state(state=5, token_id=103)
     assert fsm.is_final_state(state)
+
+
+def _mock_tokens():
+    # Letters and letter pairs, so some states allow more than the 32 transitions
+    # scanned linearly and go through the rank bitmap instead.
+    tokens = [chr(c) for c in range(ord("a"), ord("z") + 1)]
+    tokens += [a + b for a in "abcdef" for b in "abcdef"]
+    tokens += [str(d) for d in range(10)] + ["a0", "0a", "12"]
+    return tokens + ["eos"]
+
+
+def _reference_index(fsm, tokenizer):
+    """`{state: {token_id: next_state}}` built with plain dicts, by walking every token
+    through the FSM from every state."""
+    index = {}
+    for state in fsm.states:
+        transitions = {}
+        for token, token_id in tokenizer.vocabulary.items():
+            if token in tokenizer.special_tokens:
+                continue
+            next_state = state
+            for char in token:
+                next_state = fsm.map.get(next_state, {}).get(fsm.alphabet[char])
+                if next_state is None:
+                    break
+            if next_state is not None:
+                transitions[token_id] = next_state
+        if transitions:
+            index[state] = transitions
+    return index
+
+
+@pytest.mark.parametrize("regex_str", [r"[a-z]+0", r"[0-9]a?", r"a[bc]"])
+def test_lazy_fsm_index_matches_reference(regex_str, mock_tokenizer):
+    from faster_outlines.fsm.regex import create_fsm_index_tokenizer, regex_to_fsm
+
+    tokenizer = mock_tokenizer(_mock_tokens())
+    index, _, finals = create_fsm_index_tokenizer(regex_str, tokenizer)
+    expected = _reference_index(regex_to_fsm(regex_str), tokenizer)
+
+    computed = {
+        state: transitions
+        for state, transitions in index.get_states_to_token_subsets().items()
+        if transitions
+    }
+    assert computed == expected
+
+    for state, transitions in expected.items():
+        assert sorted(index.allowed_token_ids(state)) == sorted(transitions)
+        if state in finals:
+            continue
+        for token_id in tokenizer.vocabulary.values():
+            next_state = transitions.get(token_id)
+            if next_state is None or next_state in finals:
+                next_state = -1
+            assert index.get_next_state(state, token_id) == next_state
+
+
+def test_lazy_fsm_index_covers_both_lookup_paths(mock_tokenizer):
+    from faster_outlines.fsm.regex import create_fsm_index_tokenizer
+
+    # The patterns of `test_lazy_fsm_index_matches_reference` have rows on both sides
+    # of the 32 transitions scanned linearly.
+    tokenizer = mock_tokenizer(_mock_tokens())
+    row_lengths = [
+        len(transitions)
+        for regex_str in (r"[a-z]+0", r"a[bc]")
+        for transitions in create_fsm_index_tokenizer(regex_str, tokenizer)[0]
+        .get_states_to_token_subsets()
+        .values()
+        if transitions
+    ]
+    assert max(row_lengths) > 32
+    assert min(row_lengths) <= 32
+
+
+def test_lazy_fsm_index_serialization(mock_tokenizer):
+    import pickle
+
+    from faster_outlines.fsm.fsm_utils import LazyFSMIndex
+    from faster_outlines.fsm.regex import create_fsm_index_tokenizer
+
+    tokenizer = mock_tokenizer(_mock_tokens())
+    index, _, _ = create_fsm_index_tokenizer(r"[a-z]+0", tokenizer)
+    data = index.to_bytes()
+
+    for restored in (LazyFSMIndex.from_bytes(data), pickle.loads(pickle.dumps(index))):
+        assert restored.is_computing_finished()
+        assert restored.finals == index.finals
+        assert restored.get_states_to_token_subsets() == index.get_states_to_token_subsets()
+
+    with pytest.raises(ValueError):
+        LazyFSMIndex.from_bytes(data[:-4])
+    with pytest.raises(ValueError):
+        LazyFSMIndex.from_bytes(data[:-1])
+    # eos_token_id ( the third word ) outside the vocabulary.
+    with pytest.raises(ValueError):
+        LazyFSMIndex.from_bytes(data[:8] + (2**32 - 1).to_bytes(4, "little") + data[12:])
+    # Serialized for a larger vocabulary than the one it is loaded for.
+    with pytest.raises(ValueError):
+        LazyFSMIndex.from_bytes(data, 1)
+
+
+def test_create_fsm_indices_tokenizer(mock_tokenizer):
+    from faster_outlines.fsm.regex import (
+        clear_caches,
+        create_fsm_index_tokenizer,
+        create_fsm_indices_tokenizer,
+    )
+
+    tokenizer = mock_tokenizer(_mock_tokens())
+    patterns = [r"[a-z]+0", r"[0-9]a?", r"a[bc]"]
+    clear_caches()
+    # Cached before the batch, so only the other patterns go through it.
+    single = create_fsm_index_tokenizer(patterns[0], tokenizer)
+    batch = create_fsm_indices_tokenizer(patterns + patterns[:1], tokenizer)
+
+    assert len(batch) == len(patterns) + 1
+    assert batch[0] is batch[-1]
+    for _, empty_token_ids, finals in batch:
+        assert isinstance(empty_token_ids, frozenset)
+        assert isinstance(finals, frozenset)
+
+    batch_subsets = [index.get_states_to_token_subsets() for index, _, _ in batch]
+    assert single[0].get_states_to_token_subsets() == batch_subsets[0]
+    # Computed again one by one, from scratch.
+    clear_caches()
+    for pattern, (_, empty_token_ids, finals), subsets in zip(patterns, batch, batch_subsets):
+        index, expected_empty_token_ids, expected_finals = create_fsm_index_tokenizer(pattern, tokenizer)
+        assert empty_token_ids == expected_empty_token_ids
+        assert finals == expected_finals
+        assert subsets == index.get_states_to_token_subsets()
+
+
+def test_disk_cache(mock_tokenizer, monkeypatch, tmp_path):
+    import time
+
+    from faster_outlines.fsm import _disk_cache
+    from faster_outlines.fsm.regex import clear_caches, create_fsm_index_tokenizer
+
+    monkeypatch.setattr(_disk_cache, "DISK_CACHE_DIR", str(tmp_path))
+    loaded = []
+    load = _disk_cache.load
+
+    def recording_load(*args):
+        loaded.append(load(*args))
+        return loaded[-1]
+
+    monkeypatch.setattr(_disk_cache, "load", recording_load)
+
+    tokenizer = mock_tokenizer(_mock_tokens(), vocabulary_hash=1234)
+    clear_caches()
+    index, _, finals = create_fsm_index_tokenizer(r"[a-z]+0", tokenizer)
+    assert loaded == [None]
+
+    # Stored on a background thread once the index is fully computed.
+    index.await_finished()
+    deadline = time.monotonic() + 10
+    while not list(tmp_path.glob("*.fsm")) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(list(tmp_path.glob("*.fsm"))) == 1
+
+    # Also drops the rust cache, so the index can only come from the disk.
+    clear_caches()
+    restored, _, restored_finals = create_fsm_index_tokenizer(r"[a-z]+0", tokenizer)
+    assert loaded[-1] is not None
+    assert restored_finals == finals
+    assert restored.get_states_to_token_subsets() == index.get_states_to_token_subsets()
+
+
+@pytest.mark.parametrize(
+    "regex_str",
+    ["a", "yes|no|maybe", "choice 1|choice 2|car|truck|dog", "ab|", "|ab", "aa|a|", "abc|abd|bd"],
+)
+def test_literal_alternation_to_fsm(regex_str):
+    from interegular import parse_pattern
+
+    from faster_outlines.fsm.regex import literal_alternation_to_fsm
+
+    fsm = literal_alternation_to_fsm(regex_str)
+    expected = parse_pattern(regex_str).to_fsm().reduce()
+
+    assert fsm.equivalent(expected)
+    assert len(fsm.states) == len(expected.states)
+
+
+def test_literal_alternation_to_fsm_rejects_regexes():
+    from faster_outlines.fsm.regex import literal_alternation_to_fsm
+
+    assert literal_alternation_to_fsm("a+|b") is None
+    assert literal_alternation_to_fsm("(yes|no)") is None
+
+
+def test_byte_level_decoder():
+    tokenizers = pytest.importorskip("tokenizers")
+    transformers = pytest.importorskip("transformers")
+
+    from faster_outlines.fsm.tokenizer_fsm_patch import TransformerTokenizer
+
+    backend = tokenizers.Tokenizer(tokenizers.models.BPE())
+    backend.pre_tokenizer = tokenizers.pre_tokenizers.ByteLevel(add_prefix_space=False)
+    backend.decoder = tokenizers.decoders.ByteLevel()
+    trainer = tokenizers.trainers.BpeTrainer(
+        vocab_size=400,
+        special_tokens=["<eos>"],
+        initial_alphabet=tokenizers.pre_tokenizers.ByteLevel.alphabet(),
+    )
+    backend.train_from_iterator(["héllo wörld, 日本語 text\n\ttabs", "naïve café 123"], trainer)
+    hf_tokenizer = transformers.PreTrainedTokenizerFast(tokenizer_object=backend, eos_token="<eos>")
+
+    tokenizer = TransformerTokenizer(hf_tokenizer)
+    assert tokenizer.byte_decoder is not None
+
+    for token in tokenizer.vocabulary:
+        assert tokenizer.convert_token_to_string(token) == hf_tokenizer.convert_tokens_to_string([token])
+
+
+def test_get_next_instruction_jump_forward(mock_tokenizer):
+    from faster_outlines.fsm import Generate, Write
+    from faster_outlines.fsm.regex import create_fsm_index_tokenizer
+
+    tokenizer = mock_tokenizer(["a", "b", "c", "d", "eos"])
+    a, b, c, d = (tokenizer.vocabulary[token] for token in "abcd")
+    index, _, _ = create_fsm_index_tokenizer("ab[cd]", tokenizer)
+
+    instruction = index.get_next_instruction(0, jump_forward=True)
+    assert isinstance(instruction, Write)
+    assert instruction.tokens == [a, b]
+
+    # Without jump forward, one token at a time.
+    instruction = index.get_next_instruction(0)
+    assert isinstance(instruction, Generate)
+    assert instruction.tokens == [a]
+
+    state = index.get_next_state(index.get_next_state(0, a), b)
+    instruction = index.get_next_instruction(state, jump_forward=True)
+    assert isinstance(instruction, Generate)
+    assert sorted(instruction.tokens) == [c, d]
+
+
+def _small_index(mock_tokenizer):
+    from faster_outlines.fsm.regex import create_fsm_index_tokenizer
+
+    tokenizer = mock_tokenizer(["a", "b", "c", "d", "cd", "eos"])
+    index, _, finals = create_fsm_index_tokenizer(r"ab?[cd]+", tokenizer)
+    # Final states, and -1, only allow EOS.
+    states = [
+        state
+        for state, transitions in index.get_states_to_token_subsets().items()
+        if transitions or state in finals
+    ]
+    return tokenizer, index, states + [-1]
+
+
+def test_sample_allowed_token(mock_tokenizer):
+    tokenizer, index, states = _small_index(mock_tokenizer)
+    rng_state = 0
+    for state in states:
+        allowed = set(index.get_next_instruction(state).tokens)
+        sampled = set()
+        for _ in range(200):
+            token_id, rng_state = index.sample_allowed_token(state, rng_state)
+            sampled.add(token_id)
+        # Every allowed token is drawn at least once, and nothing else.
+        assert sampled == allowed
+
+
+def test_get_allowed_bitmap(mock_tokenizer):
+    import numpy as np
+
+    tokenizer, index, states = _small_index(mock_tokenizer)
+    for state in states:
+        words = np.frombuffer(index.get_allowed_bitmap(state), dtype="<u8")
+        bits = np.unpackbits(words.view(np.uint8), bitorder="little")
+        allowed = set(index.get_next_instruction(state).tokens)
+        assert set(np.flatnonzero(bits).tolist()) == allowed
+        assert (tokenizer.eos_token_id in allowed) == (state == -1 or state in index.finals)
+
+
+def test_transitions_csr(mock_tokenizer):
+    import numpy as np
+
+    _, index, _ = _small_index(mock_tokenizer)
+    row_offsets, token_ids, next_states = (
+        np.frombuffer(buffer, dtype="<u4").tolist() for buffer in index.transitions_csr()
+    )
+    assert len(row_offsets) == index.n_states() + 1
+    rebuilt = {
+        state: dict(zip(token_ids[start:end], next_states[start:end]))
+        for state, (start, end) in enumerate(zip(row_offsets, row_offsets[1:]))
+    }
+    assert rebuilt == index.get_states_to_token_subsets()
+
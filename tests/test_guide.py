@@ -1,8 +1,15 @@
+import math
+
 import pytest
-from faster_outlines import patch
-import outlines
-patch(outlines)
-from outlines.fsm.guide import Generate, RegexGuide, StopAtEOSGuide, Write
+
+
+@pytest.fixture(scope="session", autouse=True)
+def _patch_outlines():
+    # Patched once per session, before any test imports from `outlines.fsm.guide`.
+    from faster_outlines import patch
+    import outlines
+
+    patch(outlines)
 
 
 def assert_expected_tensor_ids(tensor, ids):
@@ -13,6 +20,8 @@ def assert_expected_tensor_ids(tensor, ids):
 
 
 def test_stop_at_eos():
+    from outlines.fsm.guide import Generate, StopAtEOSGuide, Write
+
     class MockTokenizer:
         vocabulary = {"a": 1, "eos": 2}
         eos_token_id = 2
@@ -46,3 +55,228 @@ def test_stop_at_eos():
 #
 #    with pytest.raises(ValueError, match="The vocabulary"):
 #        RegexGuide(regex_str, MockTokenizer())
+
+
+
+def test_get_forced_prefix(mock_tokenizer):
+    from faster_outlines.fsm.guide import RegexGuide
+
+    tokenizer = mock_tokenizer(["a", "b", "c", "d", "eos"])
+    a, b, c = (tokenizer.vocabulary[token] for token in "abc")
+
+    guide = RegexGuide("ab[cd]", tokenizer)
+    assert guide.get_forced_prefix(guide.initial_state) == [a, b]
+    state = guide.get_next_state(guide.get_next_state(guide.initial_state, a), b)
+    assert guide.get_forced_prefix(state) == []
+
+    # The walk stops at the final state, it does not force EOS.
+    guide = RegexGuide("abc", tokenizer)
+    assert guide.get_forced_prefix(guide.initial_state) == [a, b, c]
+    assert guide.get_forced_prefix(-1) == []
+
+
+def test_states_to_token_maps(mock_tokenizer):
+    from faster_outlines.fsm.guide import RegexGuide
+
+    tokenizer = mock_tokenizer(["a", "b", "c", "d", "eos"])
+    a, b, c, d = (tokenizer.vocabulary[token] for token in "abcd")
+    guide = RegexGuide("ab[cd]", tokenizer)
+
+    maps = guide.states_to_token_maps
+    # Every state, not only those computed so far.
+    (after_a,) = maps[guide.initial_state].values()
+    (after_b,) = maps[after_a].values()
+    (final,) = set(maps[after_b].values())
+    assert maps[guide.initial_state] == {a: after_a}
+    assert maps[after_a] == {b: after_b}
+    assert maps[after_b] == {c: final, d: final}
+    assert not maps.get(final)
+    assert guide.states_to_token_maps is maps
+
+
+def test_transition_arrays(mock_tokenizer):
+    import numpy as np
+
+    from faster_outlines.fsm.guide import RegexGuide
+
+    tokenizer = mock_tokenizer(["a", "b", "c", "d", "cd", "eos"])
+    guide = RegexGuide(r"ab?[cd]+", tokenizer)
+    offsets, token_ids, next_states = guide.transition_arrays
+    assert (offsets.dtype, token_ids.dtype, next_states.dtype) == (np.int64, np.int32, np.int32)
+
+    rebuilt = {
+        state: dict(zip(token_ids[start:end].tolist(), next_states[start:end].tolist()))
+        for state, (start, end) in enumerate(zip(offsets, offsets[1:]))
+    }
+    assert rebuilt == guide.states_to_token_maps
+    # Sorted within a state, for `np.searchsorted`.
+    for start, end in zip(offsets, offsets[1:]):
+        assert (np.diff(token_ids[start:end]) > 0).all()
+
+
+@pytest.mark.parametrize("regex_str", [r"(ab|c)+d?", r"[0-9]+a"])
+def test_from_interegular_fsm(mock_tokenizer, regex_str):
+    import interegular
+
+    from faster_outlines.fsm.guide import RegexGuide
+
+    tokenizer = mock_tokenizer(["a", "b", "c", "d", "ab", "cd"] + [str(d) for d in range(10)] + ["eos"])
+    guide = RegexGuide.from_interegular_fsm(interegular.parse_pattern(regex_str).to_fsm(), tokenizer)
+    expected = RegexGuide(regex_str, tokenizer)
+
+    assert guide.states_to_token_maps == expected.states_to_token_maps
+    assert guide.final_states == expected.final_states
+    for state in list(expected.states_to_token_maps) + [-1]:
+        instruction = guide.get_next_instruction(state)
+        expected_instruction = expected.get_next_instruction(state)
+        assert type(instruction) is type(expected_instruction)
+        assert sorted(instruction.tokens) == sorted(expected_instruction.tokens)
+
+
+def _digit_guide(mock_tokenizer):
+    from faster_outlines.fsm.guide import RegexGuide
+
+    tokenizer = mock_tokenizer([str(d) for d in range(10)] + ["a", "b", "1a", "eos"])
+    guide = RegexGuide("[0-9]a", tokenizer)
+    # After a digit only "a" is allowed, -1 ( final ) only allows EOS.
+    states = (guide.initial_state, guide.get_next_state(guide.initial_state, 1), -1)
+    return guide, len(tokenizer.vocabulary), states
+
+
+def _reference_masked_logits(guide, state, logits):
+    import torch
+
+    allowed = torch.tensor(guide.fsm.allowed_token_ids(state), dtype=torch.long)
+    masked = torch.full_like(logits, -math.inf)
+    masked[..., allowed] = logits[..., allowed]
+    return masked
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float16", "bfloat16"])
+def test_mask_logits(mock_tokenizer, dtype):
+    import torch
+
+    guide, vocab_size, states = _digit_guide(mock_tokenizer)
+    for state in states:
+        logits = torch.randn(vocab_size).to(getattr(torch, dtype))
+        original = logits.clone()
+
+        masked = guide.mask_logits(state, logits)
+        assert masked.dtype == logits.dtype
+        assert torch.equal(masked, _reference_masked_logits(guide, state, logits))
+        assert torch.equal(logits, original)
+
+
+def test_mask_logits_in_place(mock_tokenizer):
+    import torch
+
+    guide, vocab_size, states = _digit_guide(mock_tokenizer)
+    for state in states:
+        logits = torch.randn(2, vocab_size)
+        expected = _reference_masked_logits(guide, state, logits)
+
+        masked = guide.mask_logits_(state, logits)
+        assert masked.data_ptr() == logits.data_ptr()
+        assert torch.equal(masked, expected)
+
+
+def test_mask_logits_batch(mock_tokenizer):
+    import torch
+
+    guide, vocab_size, (initial, state, final) = _digit_guide(mock_tokenizer)
+    # Twice, so the second batch is gathered from the bank and its reused buffer.
+    for states in ([initial, final, state, initial], [state, initial, final, final]):
+        logits = torch.randn(len(states), vocab_size)
+        expected = torch.stack(
+            [_reference_masked_logits(guide, s, row) for s, row in zip(states, logits)]
+        )
+
+        masked = guide.mask_logits_batch(states, logits)
+        assert masked.data_ptr() == logits.data_ptr()
+        assert torch.equal(masked, expected)
+
+    with pytest.raises(ValueError):
+        guide.mask_logits_batch([initial, state], torch.randn(3, vocab_size))
+
+
+def test_logits_masks_are_pooled(mock_tokenizer):
+    import torch
+
+    from faster_outlines.fsm.guide import RegexGuide
+
+    tokenizer = mock_tokenizer([str(d) for d in range(10)] + ["a", "b", "1a", "eos"])
+    vocab_size = len(tokenizer.vocabulary)
+    # Different patterns, whose initial states allow the same tokens.
+    first, second = RegexGuide("[0-9]a", tokenizer), RegexGuide("[0-9]ab?", tokenizer)
+
+    mask = first.get_logits_mask(first.initial_state, vocab_size)
+    assert second.get_logits_mask(second.initial_state, vocab_size) is mask
+
+    half_mask = second.get_logits_mask(second.initial_state, vocab_size, dtype=torch.float16)
+    assert half_mask.dtype == torch.float16
+    assert half_mask is not mask
+    assert len(RegexGuide._logits_mask_cache) <= RegexGuide._logits_mask_cache.maxsize
+
+
+def test_prepare(mock_tokenizer):
+    from faster_outlines.fsm.guide import RegexGuide
+
+    tokenizer = mock_tokenizer(["a", "b", "c", "ab", "eos"])
+    expected = RegexGuide("(ab|c)+", tokenizer)
+    guide = RegexGuide.prepare("(ab|c)+", tokenizer)
+
+    # Resolved on first access to the index.
+    assert guide.get_next_state(guide.initial_state, tokenizer.vocabulary["ab"]) == expected.get_next_state(
+        expected.initial_state, tokenizer.vocabulary["ab"]
+    )
+    assert guide.final_states == expected.final_states
+    assert guide.states_to_token_maps == expected.states_to_token_maps
+    assert "_pending" not in guide.__dict__
+
+
+def test_prefetch(mock_tokenizer):
+    import torch
+
+    from faster_outlines.fsm.guide import RegexGuide, _default_prefetch_device
+
+    tokenizer = mock_tokenizer(["a", "b", "c", "ab", "eos"])
+    guide = RegexGuide("a(b|c)c", tokenizer)
+    guide.prefetch(10, "cpu").join()
+
+    cpu = torch.device("cpu")
+    prefetched = {state for state, device in guide.states_to_token_masks if device == cpu}
+    assert guide.initial_state in prefetched
+    assert set(guide.fsm.next_states(guide.initial_state)) <= prefetched
+    for state in prefetched:
+        assert sorted(guide.states_to_token_masks[(state, cpu)].tolist()) == sorted(
+            guide.fsm.allowed_token_ids(state)
+        )
+
+    # Without a device, the tensors go where the logits are expected to be.
+    guide = RegexGuide("a(b|c)c", tokenizer)
+    guide.prefetch(1).join()
+    assert list(guide.states_to_token_masks) == [(guide.initial_state, _default_prefetch_device())]
+
+
+def test_clear_cache(mock_tokenizer):
+    import torch
+
+    from faster_outlines.fsm.environment import DISABLE_CACHE
+    from faster_outlines.fsm.guide import RegexGuide
+
+    if DISABLE_CACHE:
+        pytest.skip("The python caches are not installed")
+
+    tokenizer = mock_tokenizer(["a", "b", "eos"])
+    guide = RegexGuide("a+b", tokenizer)
+    guide.mask_logits(guide.initial_state, torch.zeros(len(tokenizer.vocabulary)))
+    # Guides of the same pattern and tokenizer share their index.
+    assert RegexGuide("a+b", tokenizer).fsm is guide.fsm
+
+    RegexGuide.clear_cache()
+
+    assert len(RegexGuide._mask_cache) == 0
+    assert len(RegexGuide._logits_mask_cache) == 0
+    rebuilt = RegexGuide("a+b", tokenizer)
+    assert rebuilt.fsm is not guide.fsm
+    assert rebuilt.states_to_token_maps == guide.states_to_token_maps